@@ -0,0 +1,151 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+import queue
+import threading
+import time
+
+from database import connect
+from event_handler import consume_events
+from partition import group_by_partition
+
+ACK_BATCH_SIZE = int(os.getenv("ACK_BATCH_SIZE", "500"))
+ACK_FLUSH_SECONDS = float(os.getenv("ACK_FLUSH_SECONDS", "0.5"))
+ACK_MAX_BACKOFF_SECONDS = float(os.getenv("ACK_MAX_BACKOFF_SECONDS", "60"))
+ACK_TIMEOUT_SECONDS = float(os.getenv("ACK_TIMEOUT_SECONDS", "5"))
+# How long applied event ids are remembered to skip a second delivery
+APPLIED_EVENT_RETENTION_SECONDS = int(
+    os.getenv("APPLIED_EVENT_RETENTION_SECONDS", "86400")
+)
+PRUNE_INTERVAL_SECONDS = 60
+
+pending_acks = queue.Queue()
+
+
+# ===================================================
+# Queue applied events to be marked as consumed.
+# Must be called after the events are committed locally:
+# the request handler returns without waiting for the ack.
+# ===================================================
+def ack_events(event_ids: list):
+    for event_id in event_ids:
+        pending_acks.put(event_id)
+
+
+# Collects up to ACK_BATCH_SIZE ids, waiting at most
+# ACK_FLUSH_SECONDS after the first one for more to arrive
+def collect(batch: list, block: bool = True):
+    if block and not batch:
+        batch.append(pending_acks.get())
+
+    deadline = time.monotonic() + (ACK_FLUSH_SECONDS if block else 0)
+    while len(batch) < ACK_BATCH_SIZE:
+        try:
+            batch.append(pending_acks.get(timeout=max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+            break
+    return batch
+
+
+def send_partition(SYNC_SERVICE_BASE_URL: str, BRANCH_ID: str, batch: list):
+    try:
+        result = consume_events(
+            SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
+            BRANCH_ID=BRANCH_ID,
+            event_ids=batch,
+            timeout=ACK_TIMEOUT_SECONDS,
+        )
+        if result.status_code != 200:
+            print(f"Ack failed: {result.status_code} {result.text}")
+            return False
+    except Exception as e:
+        print(f"Ack failed: {str(e)}")
+        return False
+
+    print(f"Acked {result.json()['consumed']} of {len(batch)} events")
+    return True
+
+
+# Each event id is acked on the partition that numbered it.
+# Returns the ids whose partition failed, to be retried
+def send(SYNC_SERVICE_URLS: list, BRANCH_ID: str, batch: list):
+    unsent = []
+    for partition, event_ids in group_by_partition(
+        batch, key=lambda event_id: event_id
+    ).items():
+        if not send_partition(SYNC_SERVICE_URLS[partition], BRANCH_ID, event_ids):
+            unsent.extend(event_ids)
+    return unsent
+
+
+# Acked events are no longer delivered, so their applied_event
+# rows are only kept for a second delivery already in flight
+def prune_applied_events(conn):
+    pruned = conn.execute(
+        "DELETE FROM applied_event WHERE applied_at < datetime('now', ?)",
+        (f"-{APPLIED_EVENT_RETENTION_SECONDS} seconds",),
+    ).rowcount
+    conn.commit()
+    if pruned:
+        print(f"Pruned {pruned} applied event ids")
+
+
+def ack_forever(SYNC_SERVICE_URLS: list, BRANCH_ID: str):
+    conn = connect()
+    batch = []
+    backoff = 1.0
+    last_prune = 0.0
+
+    while True:
+        collect(batch)
+        batch = send(SYNC_SERVICE_URLS, BRANCH_ID, batch)
+        if not batch:
+            backoff = 1.0
+            if time.monotonic() - last_prune >= PRUNE_INTERVAL_SECONDS:
+                try:
+                    prune_applied_events(conn)
+                except Exception as e:
+                    conn.rollback()
+                    print(f"Applied event prune failed: {str(e)}")
+                last_prune = time.monotonic()
+            continue
+
+        # The unsent ids are kept and retried; acks are idempotent
+        time.sleep(backoff)
+        backoff = min(backoff * 2, ACK_MAX_BACKOFF_SECONDS)
+
+
+# ===================================================
+# Send whatever is still queued, once, without waiting.
+# Called on shutdown so applied events are not replayed
+# on the next start.
+# ===================================================
+def flush_acks(SYNC_SERVICE_URLS: list, BRANCH_ID: str):
+    while not pending_acks.empty():
+        if send(SYNC_SERVICE_URLS, BRANCH_ID, collect([], block=False)):
+            return
+
+
+# ===================================================
+# Background acker:
+# 1. Groups the acks of /notify and catch-up into batches
+# 2. Sends each batch with one PATCH /event/consume call per
+# sync service partition
+# 3. Retries with exponential backoff on failure
+# ===================================================
+def start_acker(SYNC_SERVICE_URLS: list, BRANCH_ID: str):
+    thread = threading.Thread(
+        target=ack_forever,
+        args=(SYNC_SERVICE_URLS, BRANCH_ID),
+        name="event-acker",
+        daemon=True,
+    )
+    thread.start()
+    return thread
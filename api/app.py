@@ -23,87 +23,117 @@
 # [x] update product
 # [x] Authentication
 #
-import sqlite3
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import timedelta
 from sqlite3 import Connection, IntegrityError
+from typing import List
 
-import requests
+import httpx
 import uvicorn
+from acker import ack_events, flush_acks, start_acker
 from auth import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     authenticate_user,
     create_access_token,
     get_current_user,
+    token_cache,
 )
-from database import get_db, start_database
-from event_handler import consume_create, consume_update, publish_event
-from fastapi import Depends, FastAPI, HTTPException, status
+from cache import product_cache
+from config import BASE_URL, BRANCH_ID, PORT, SYNC_SERVICE_URLS, WORKERS
+from database import DATABASE, DataVersionWatcher, get_db, start_database
+from event_handler import apply_events
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Response, status
+from fastapi.concurrency import run_in_threadpool
+from http_client import async_client, close_clients, sync_call_seconds
+from leader import file_lock, leader
+from metrics import CONTENT_TYPE, Counter, MetricsMiddleware, render, timed
 from models import LoginIn, NotifyIn, PlaceOrderIn, ProductIn, ProductUpdateIn, Token
-from starlette.status import HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR
+from outbox import enqueue_event, outbox_stats, wake_dispatcher
+from partition import group_by_partition, partition_url
+from starlette.status import (
+    HTTP_201_CREATED,
+    HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
+    HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_502_BAD_GATEWAY,
+    HTTP_503_SERVICE_UNAVAILABLE,
+)
+from startup import load_startup_state, start_startup_sync, startup_state
+
+router = APIRouter()
 
-api = FastAPI()
-BRANCH_ID = "bb5942cb28ff48f3420f0c13e9187746"
-PORT = 4444
-BASE_URL = f"http://localhost:{PORT}"
-SYNC_SERVICE_BASE_URL = "http://localhost:4000"
-start_database()
+product_request_total = Counter(
+    "product_request_total",
+    "Order items processed, by final status.",
+    ("status",),
+)
 
 
 # ===================================================
-# Startup initialization:
-# 1. Subscribe on sync service
-# 2. Search for non-consumed events to apply updates
+# Service lifecycle, in every worker:
+# 1. Create/migrate the local database, one worker at a time
+# 2. Start acking applied events in background, in batches
+# 3. Elect the leader (leader.py). Only the leader subscribes,
+# starts the outbox and replays non-consumed events in background
+# (startup.py), so requests are served right away
+# 4. With WORKERS > 1, the product cache is dropped whenever
+# another worker commits
+# On shutdown, acks still queued are sent, so the applied events
+# are not replayed on the next start.
 # ===================================================
-@api.on_event("startup")
-def subscribe_sync():
-    result = requests.post(
-        f"{SYNC_SERVICE_BASE_URL}/subscribe",
-        json={"branch_id": BRANCH_ID, "branch_url": BASE_URL},
-    )
-    print("Subscription result: ", result.status_code, result.json())
-    non_consumed_events = requests.get(
-        f"{SYNC_SERVICE_BASE_URL}/event/non-consumed/{BRANCH_ID}"
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with file_lock(f"{DATABASE}.startup"):
+        start_database()
+    start_acker(SYNC_SERVICE_URLS=SYNC_SERVICE_URLS, BRANCH_ID=BRANCH_ID)
+    leader.start(
+        on_elected=lambda: start_startup_sync(
+            SYNC_SERVICE_URLS=SYNC_SERVICE_URLS,
+            BRANCH_ID=BRANCH_ID,
+            BASE_URL=BASE_URL,
+        )
     )
+    if WORKERS > 1:
+        product_cache.watch(DataVersionWatcher())
+
+    yield
 
-    non_consumed_events_data = non_consumed_events.json()
-    print(
-        "non-consumed events: ",
-        non_consumed_events.status_code,
-        non_consumed_events_data,
+    await run_in_threadpool(
+        flush_acks, SYNC_SERVICE_URLS=SYNC_SERVICE_URLS, BRANCH_ID=BRANCH_ID
     )
+    await close_clients()
 
-    conn = sqlite3.connect("product_database.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    for event in non_consumed_events_data:
-        if event["publisher_id"] == BRANCH_ID:
-            print("Ignore event from own branch")
-            continue
-        if event["operation"] == "CREATE":
-            consume_create(
-                db=conn,
-                cursor=cursor,
-                notify_data=NotifyIn(
-                    event_consumer_id=event["id"],
-                    publisher_branch_id=event["publisher_id"],
-                    operation=event["operation"],
-                    sub=event["sub"],
-                    initial_balance=event["initial_balance"],
-                    current_balance=event["current_balance"],
-                    delta=event["delta"],
-                ),
-                BRANCH_ID=BRANCH_ID,
-            )
 
-    conn.close()
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+# ===================================================
+# Readiness: 200 once subscribed and caught up with the events
+# missed while the branch was down, 503 (with the catch-up
+# progress) until then. Products may still be stale before that.
+# The other workers answer with the state saved by the leader.
+# ===================================================
+@router.get("/ready")
+def ready(response: Response, db: Connection = Depends(get_db)):
+    state = startup_state.to_dict() if leader.is_leader else load_startup_state(db)
+    if state is None:
+        state = {"ready": False, "detail": "No leader has started yet"}
+
+    if not state["ready"]:
+        response.status_code = HTTP_503_SERVICE_UNAVAILABLE
+    return state
 
 
 # ===================================================
 # Login route - no authentication required
 # Returns JWT token for subsequent requests
 # ===================================================
-@api.post("/login", response_model=Token)
+@router.post("/login", response_model=Token)
 def login(login_data: LoginIn):
     if not authenticate_user(login_data.username, login_data.password):
         raise HTTPException(
@@ -122,10 +152,11 @@ def login(login_data: LoginIn):
 # ===================================================
 # Create product:
 # 1. Create product locally
-# 2. Publish event: operation=CREATE
-# The sync service will handle the distribution of the event
+# 2. Enqueue event in the outbox, in the same transaction: operation=CREATE
+# The outbox dispatcher publishes it and the sync service
+# will handle the distribution of the event
 # ===================================================
-@api.post("/product")
+@router.post("/product")
 def create_product(
     product_data: ProductIn,
     db: Connection = Depends(get_db),
@@ -138,19 +169,17 @@ def create_product(
             "INSERT INTO product (id, current_balance) VALUES (?, ?)",
             (product_data.id, product_data.initial_balance),
         )
-
-        db.commit()
-
-        result = publish_event(
-            BRANCH_ID=BRANCH_ID,
-            SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
+        enqueue_event(
+            cursor=cursor,
             operation="CREATE",
             sub=product_data.id,
             initial_balance=product_data.initial_balance,
             current_balance=0,
             delta=0,
         )
-        print("Publish result: ", result.status_code)
+
+        db.commit()
+        wake_dispatcher.set()
 
         return {"message": f"{product_data.id} create"}
     except IntegrityError as e:
@@ -161,95 +190,152 @@ def create_product(
 
 # ===================================================
 # Listen notifications from sync service:
-# 1. When an event occur, the sync service will call this route
-# for every listener subscribed in the event
-# 2. Handle appropriately based on event operation
-# 3. Call the consume route to mark the event as consumed
+# 1. When events occur, the sync service will call this route
+# once per subscriber, with the whole batch of events
+# 2. Apply every event of the batch in one transaction
+# 3. Invalidate the cached products the batch touched
+# 4. Queue the applied events to be acked in background, in batches
 # ===================================================
-@api.post("/notify")
-def notify(notify_data: NotifyIn, db: Connection = Depends(get_db)):
-    if notify_data.publisher_branch_id == BRANCH_ID:
-        print("Ignore event from own branch")
-        return
+@router.post("/notify")
+def notify(notify_data: List[NotifyIn], db: Connection = Depends(get_db)):
     try:
         cursor = db.cursor()
-        if notify_data.operation == "CREATE":
-            consume_create(
-                db=db, cursor=cursor, notify_data=notify_data, BRANCH_ID=BRANCH_ID
-            )
-        elif notify_data.operation == "UPDATE":
-            consume_update(
-                db=db, cursor=cursor, notify_data=notify_data, BRANCH_ID=BRANCH_ID
-            )
-    except HTTPException:
-        raise
+        applied, missing = apply_events(cursor, notify_data, BRANCH_ID)
+        db.commit()
+        product_cache.invalidate({event.sub for event in notify_data})
+        print("Sync OK.")
+        ack_events(applied)
     except Exception as e:
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Internal server error: {str(e)}",
         )
 
+    if missing:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Product not found")
+
 
-@api.get("/product/{id}")
+# ===================================================
+# Get product:
+# 1. Served from the product cache when present
+# 2. Otherwise read from the database and cached, unless a
+# write invalidated the cache while it was being read
+# ===================================================
+@router.get("/product/{id}")
 def select_product_by_id(
     id: int,
     db: Connection = Depends(get_db),
     current_user: str = Depends(get_current_user),
 ):
+    product = product_cache.get(id)
+    if product is not None:
+        return product
+
     cursor = db.cursor()
 
+    generation = product_cache.generation()
     product = cursor.execute("SELECT * FROM product WHERE id = ?", (id,)).fetchone()
 
     if product is None:
         raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Product not found.")
+
+    product = dict(product)
+    product_cache.put(id, product, generation)
     return product
 
 
 # ===================================================
-# Update product:
-# 1. Lock the product to prevent concurrent updates
-# 2. Update product balance locally
-# 3. Publish UPDATE event to sync with other branches
-# 4. Release the lock
+# Prometheus metrics of this worker: latency per endpoint and per
+# call to the sync service, SQLite commit times and order item
+# outcomes (see metrics.py)
 # ===================================================
-@api.patch("/product/{id}")
-def update_product(
-    id: int,
-    product_update: ProductUpdateIn,
-    db: Connection = Depends(get_db),
-    current_user: str = Depends(get_current_user),
-):
+@router.get("/metrics")
+def get_metrics():
+    return Response(content=render(), media_type=CONTENT_TYPE)
+
+
+@router.get("/cache/stats")
+def cache_stats():
+    return {"product": product_cache.stats(), "token": token_cache.stats()}
+
+
+# Events waiting in the outbox (and the last publish error), and
+# events the sync service refused for good (outbox_dead_letter)
+@router.get("/outbox/stats")
+def get_outbox_stats(db: Connection = Depends(get_db)):
+    return outbox_stats(db)
+
+
+# Runs in the threadpool: the commit may wait on the database lock.
+# Returns the previous balance, or None when the product does not exist.
+def write_product_update(db: Connection, id: int, current_balance: int):
     cursor = db.cursor()
 
-    # Check if product exists
+    # Check if product exists, read under the product's lock
     product = cursor.execute(
         "SELECT id, current_balance FROM product WHERE id = ?", (id,)
     ).fetchone()
-
     if product is None:
-        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Product not found.")
+        return None
+
+    # Calculate delta for event publishing
+    previous_balance = product[1]
+    delta = current_balance - previous_balance
+
+    # Update product balance
+    cursor.execute(
+        "UPDATE product SET current_balance = ? WHERE id = ?",
+        (current_balance, id),
+    )
+
+    # Enqueue UPDATE event to sync with other branches
+    enqueue_event(
+        cursor=cursor,
+        operation="UPDATE",
+        sub=id,
+        initial_balance=0,
+        current_balance=current_balance,
+        delta=delta,
+    )
+    db.commit()
+    product_cache.invalidate([id])
+    wake_dispatcher.set()
+    return previous_balance
 
-    current_balance = product[1]
 
+# ===================================================
+# Update product:
+# 1. Lock the product to prevent concurrent updates
+# 2. Read the current balance, update it locally and enqueue
+# the UPDATE event to sync with other branches, in one
+# threadpool call
+# 3. Release the lock
+# The lock calls are awaited on the shared keep-alive client and
+# the database work runs in the threadpool, so the event loop
+# never waits on the sync service or on SQLite.
+# ===================================================
+@router.patch("/product/{id}")
+async def update_product(
+    id: int,
+    product_update: ProductUpdateIn,
+    db: Connection = Depends(get_db),
+    current_user: str = Depends(get_current_user),
+):
     try:
-        # Get lock to prevent concurrent updates
-        get_lock_response = requests.get(
-            f"{SYNC_SERVICE_BASE_URL}/lock?product_id={id}"
-        )
+        # Lock product to prevent concurrent updates (atomic try-acquire)
+        with timed(sync_call_seconds, call="lock"):
+            lock_product_response = await async_client.post(
+                f"{partition_url(id)}/lock",
+                json={"branch": BRANCH_ID, "product_id": id},
+            )
 
-        if get_lock_response.status_code != HTTP_404_NOT_FOUND:
+        if lock_product_response.status_code == HTTP_409_CONFLICT:
             raise HTTPException(
-                status_code=409,
+                status_code=HTTP_409_CONFLICT,
                 detail=f"Product {id} is currently locked by another operation",
             )
 
-        # Lock product
-        lock_product_response = requests.post(
-            f"{SYNC_SERVICE_BASE_URL}/lock",
-            json={"branch": BRANCH_ID, "product_id": id},
-        )
-
-        if lock_product_response.status_code != 200:
+        if lock_product_response.status_code != HTTP_201_CREATED:
             raise HTTPException(
                 status_code=HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Failed to acquire lock for product update",
@@ -259,43 +345,30 @@ def update_product(
         lock_id = lock_product_response_data["lock_id"]
 
         try:
-            # Update product balance
-            cursor.execute(
-                "UPDATE product SET current_balance = ? WHERE id = ?",
-                (product_update.current_balance, id),
-            )
-            db.commit()
-
-            # Calculate delta for event publishing
-            delta = product_update.current_balance - current_balance
-
-            # Publish UPDATE event to sync with other branches
-            publish_result = publish_event(
-                BRANCH_ID=BRANCH_ID,
-                SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
-                operation="UPDATE",
-                sub=id,
-                initial_balance=0,
-                current_balance=product_update.current_balance,
-                delta=delta,
-            )
-
-            print(
-                f"Update published for product {id}: {publish_result.status_code}, {publish_result.json()}"
+            previous_balance = await run_in_threadpool(
+                write_product_update,
+                db,
+                id,
+                product_update.current_balance,
             )
+            if previous_balance is None:
+                raise HTTPException(
+                    status_code=HTTP_404_NOT_FOUND, detail="Product not found."
+                )
 
             return {
                 "message": f"Product {id} updated successfully",
-                "previous_balance": current_balance,
+                "previous_balance": previous_balance,
                 "new_balance": product_update.current_balance,
-                "delta": delta,
+                "delta": product_update.current_balance - previous_balance,
             }
 
         finally:
             # Always release the lock
-            unlock_response = requests.patch(
-                f"{SYNC_SERVICE_BASE_URL}/lock/{lock_id}/release"
-            )
+            with timed(sync_call_seconds, call="lock_release"):
+                unlock_response = await async_client.patch(
+                    f"{partition_url(id)}/lock/{lock_id}/release"
+                )
             print(
                 f"Lock released for product {id}: {unlock_response.status_code}, {unlock_response.json()}"
             )
@@ -310,153 +383,207 @@ def update_product(
 
 
 # ===================================================
-# Place order with various items:
-# 1. When an event occur, the sync service will call this route
+# Process every item of an order in a single transaction:
+# a conditional UPDATE takes the quantity only if the balance
+# is enough, the final status of each item is written once and
+# an UPDATE event is enqueued per confirmed item.
+# Runs in the threadpool: the commit may wait on the database lock.
+# Returns (request_id, confirmed items).
 # ===================================================
-@api.post("/place-order")
-def place_order(
-    place_order_data: PlaceOrderIn,
-    db: Connection = Depends(get_db),
-    current_user: str = Depends(get_current_user),
-):
+def process_order(db: Connection, items: list, lock_ids: dict):
     cursor = db.cursor()
 
     updates_to_publish = {}
 
-    try:
-        request_id = cursor.execute(
-            "INSERT INTO request (created_at) VALUES (datetime('now'))"
-        ).lastrowid
-        print(f"request_id: {request_id}")
-
-        for item in place_order_data.items:
-            product = cursor.execute(
-                "SELECT id, current_balance FROM product WHERE id = ?",
-                (item.product_id,),
-            ).fetchone()
-
-            if product is None:
-                raise HTTPException(
-                    status_code=HTTP_404_NOT_FOUND,
-                    detail=f"Product {item.product_id} not found.",
+    request_id = cursor.execute(
+        "INSERT INTO request (created_at) VALUES (datetime('now'))"
+    ).lastrowid
+    print(f"request_id: {request_id}")
+
+    product_requests = []
+    for item in items:
+        if item.product_id not in lock_ids:
+            status = "CANCELLED_BY_LOCK"
+            print(f"Product {item.product_id} locked.")
+        else:
+            # Process order -> update product + enqueue update event -> confirm
+            updated = cursor.execute(
+                "UPDATE product SET current_balance = current_balance - ? WHERE id = ? AND current_balance >= ?",
+                (item.quantity, item.product_id, item.quantity),
+            ).rowcount
+
+            if updated == 0:
+                status = "INSUFFICIENT_BALANCE"
+            else:
+                status = "CONFIRMED"
+                enqueue_event(
+                    cursor=cursor,
+                    operation="UPDATE",
+                    sub=item.product_id,
+                    initial_balance=0,
+                    current_balance=0,
+                    delta=-item.quantity,
                 )
+                updates_to_publish[item.product_id] = -item.quantity
 
-            current_balance = product[1]
-            status = "NEW"
+        product_requests.append((item.product_id, request_id, item.quantity, status))
 
-            product_request_id = cursor.execute(
-                "INSERT INTO product_request (product_id, request_id, quantity, status) VALUES (?, ?, ?, ?)",
-                (item.product_id, request_id, item.quantity, status),
-            ).lastrowid
-            db.commit()
-
-            # Get lock
-            get_lock_response = requests.get(
-                f"{SYNC_SERVICE_BASE_URL}/lock?product_id={item.product_id}"
-            )
+    cursor.executemany(
+        "INSERT INTO product_request (product_id, request_id, quantity, status) VALUES (?, ?, ?, ?)",
+        product_requests,
+    )
+    db.commit()
+    product_cache.invalidate(updates_to_publish.keys())
+    wake_dispatcher.set()
+    for _, _, _, status in product_requests:
+        product_request_total.inc(status=status)
+
+    print(f"updates to publish: {len(updates_to_publish)}")
+    return request_id, len(updates_to_publish)
+
+
+# Runs in the threadpool. Returns the ids of `product_ids` that do
+# not exist in this branch.
+def missing_products(db: Connection, product_ids: list):
+    found = {
+        row[0]
+        for row in db.execute(
+            f"SELECT id FROM product WHERE id IN ({', '.join('?' * len(product_ids))})",
+            product_ids,
+        )
+    }
+    return [product_id for product_id in product_ids if product_id not in found]
 
-            if get_lock_response.status_code != HTTP_404_NOT_FOUND:
-                status = "CANCELLED_BY_LOCK"
-                cursor.execute(
-                    "UPDATE product_request SET status = ? WHERE id = ? ",
-                    (status, product_request_id),
-                )
-                db.commit()
-                print(f"Product {item.product_id} locked. {get_lock_response.json()}")
-                continue
-
-            # Lock product
-            lock_product_response = requests.post(
-                f"{SYNC_SERVICE_BASE_URL}/lock",
-                json={"branch": BRANCH_ID, "product_id": item.product_id},
-            )
 
-            lock_product_response_data = lock_product_response.json()
-            print(
-                "lock_product_response: ",
-                lock_product_response.status_code,
-                lock_product_response.json(),
+# Lock the products of one sync service partition with one call
+# (best effort). Returns {product_id: lock_id} of the products locked;
+# products locked elsewhere are left out (their items are cancelled).
+# A partition that can not answer is an error (503, or 502 for any
+# other unexpected answer), not a lock conflict.
+async def lock_partition(SYNC_SERVICE_BASE_URL: str, product_ids: list):
+    try:
+        with timed(sync_call_seconds, call="lock_batch"):
+            lock_response = await async_client.post(
+                f"{SYNC_SERVICE_BASE_URL}/lock/batch",
+                json={
+                    "branch": BRANCH_ID,
+                    "product_ids": product_ids,
+                    "all_or_nothing": False,
+                },
             )
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Sync service unavailable: {str(e)}",
+        )
 
-            if current_balance - item.quantity < 0:
-                status = "INSUFFICIENT_BALANCE"
-                cursor.execute(
-                    "UPDATE product_request SET status = ? WHERE id = ? ",
-                    (status, product_request_id),
-                )
-                db.commit()
+    if lock_response.status_code != HTTP_201_CREATED:
+        print("lock_response: ", lock_response.status_code, lock_response.text)
+        raise HTTPException(
+            status_code=(
+                HTTP_503_SERVICE_UNAVAILABLE
+                if lock_response.status_code == HTTP_503_SERVICE_UNAVAILABLE
+                else HTTP_502_BAD_GATEWAY
+            ),
+            detail=f"Failed to lock products {product_ids}: "
+            f"{lock_response.status_code} {lock_response.text}",
+        )
 
-                unlock_response = requests.patch(
-                    f"{SYNC_SERVICE_BASE_URL}/lock/{lock_product_response_data['lock_id']}/release"
-                )
+    lock_response_data = lock_response.json()
+    print("lock_response: ", lock_response.status_code, lock_response_data)
+    return {lock["product_id"]: lock["lock_id"] for lock in lock_response_data["locks"]}
 
-                print(
-                    f"unlock_response: {unlock_response.status_code}, {unlock_response.json()}"
-                )
-                continue
 
-            status = "IN_PROGRESS"
+# Release locks of one sync service partition with one call
+async def release_partition(SYNC_SERVICE_BASE_URL: str, lock_ids: list):
+    with timed(sync_call_seconds, call="lock_batch_release"):
+        unlock_response = await async_client.patch(
+            f"{SYNC_SERVICE_BASE_URL}/lock/batch/release",
+            json={"lock_ids": lock_ids},
+        )
+    print(f"unlock_response: {unlock_response.status_code}, {unlock_response.json()}")
 
-            cursor.execute(
-                "UPDATE product_request SET status = ? WHERE id = ? ",
-                (status, product_request_id),
-            )
-            db.commit()
 
-            # Process order -> update product -> confirm -> publish update event to other branches -> unlock
-            new_balance = current_balance - item.quantity
-            cursor.execute(
-                "UPDATE product SET current_balance = ? WHERE id = ?",
-                (new_balance, item.product_id),
-            )
-            db.commit()
-            print(f"Product {item.product_id}, new_balance: {new_balance}")
-            cursor.execute(
-                "UPDATE product_request SET status = ? WHERE id = ? ",
-                ("CONFIRMED", product_request_id),
+# Release every lock of `lock_ids` ({product_id: lock_id}) on the
+# partition of its product, all partitions at once
+async def release_locks(lock_ids: dict):
+    await asyncio.gather(
+        *(
+            release_partition(
+                SYNC_SERVICE_URLS[partition],
+                [lock_ids[product_id] for product_id in product_ids],
             )
-            db.commit()
-
-            updates_to_publish[item.product_id] = -item.quantity
+            for partition, product_ids in group_by_partition(
+                lock_ids, key=lambda product_id: product_id
+            ).items()
+        )
+    )
 
-            print(f"updates to publish: {len(updates_to_publish)}")
 
-            for product_id, delta in updates_to_publish.items():
-                print(f"Publish: UPDATE product {product_id}, delta: {delta}")
-                publish_result = publish_event(
-                    BRANCH_ID=BRANCH_ID,
-                    SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
-                    operation="UPDATE",
-                    sub=product_id,
-                    initial_balance=0,
-                    current_balance=0,
-                    delta=delta,
-                )
-                print(
-                    "Publish result: ",
-                    publish_result.status_code,
-                    publish_result.json(),
-                )
-
-            unlock_response = requests.patch(
-                f"{SYNC_SERVICE_BASE_URL}/lock/{lock_product_response_data['lock_id']}/release"
-            )
+# ===================================================
+# Place order with various items:
+# 1. Look up all the order's products with one query, in the
+# threadpool like every database call of this handler
+# 2. Lock all the order's products with one batch call per sync
+# service partition, all partitions at once
+# 3. Process every item in a single transaction (process_order)
+# 4. Release all the locks the same way
+# The lock calls are awaited on the shared keep-alive client,
+# so many orders can wait on the sync service at once without
+# exhausting the threadpool.
+# ===================================================
+@router.post("/place-order")
+async def place_order(
+    place_order_data: PlaceOrderIn,
+    db: Connection = Depends(get_db),
+    current_user: str = Depends(get_current_user),
+):
+    product_ids = sorted({item.product_id for item in place_order_data.items})
+    missing = await run_in_threadpool(missing_products, db, product_ids)
+    if missing:
+        raise HTTPException(
+            status_code=HTTP_404_NOT_FOUND,
+            detail=f"Product {missing[0]} not found.",
+        )
 
-            print(
-                f"unlock_response: {unlock_response.status_code}, {unlock_response.json()}"
-            )
+    # Lock every product of the order (best effort): items whose
+    # product is already locked are cancelled
+    locked = await asyncio.gather(
+        *(
+            lock_partition(SYNC_SERVICE_URLS[partition], partition_product_ids)
+            for partition, partition_product_ids in group_by_partition(
+                product_ids, key=lambda product_id: product_id
+            ).items()
+        ),
+        return_exceptions=True,
+    )
+    lock_ids = {}
+    for partition_lock_ids in locked:
+        if not isinstance(partition_lock_ids, Exception):
+            lock_ids.update(partition_lock_ids)
+    errors = [error for error in locked if isinstance(error, Exception)]
+    if errors:
+        # A partition failed: give back what the others locked
+        await release_locks(lock_ids)
+        raise errors[0]
 
-        return {
-            "request_id": request_id,
-            "message": "Request created. Check the items' statuses",
-            "confirmed_items": len(updates_to_publish),
-        }
+    try:
+        request_id, confirmed_items = await run_in_threadpool(
+            process_order, db, place_order_data.items, lock_ids
+        )
+    finally:
+        # Release every lock of the order
+        if lock_ids:
+            await release_locks(lock_ids)
 
-    except HTTPException:
-        raise
+    return {
+        "request_id": request_id,
+        "message": "Request created. Check the items' statuses",
+        "confirmed_items": confirmed_items,
+    }
 
 
-@api.get("/order/{id}")
+@router.get("/order/{id}")
 def get_order_details(
     id: int,
     db: Connection = Depends(get_db),
@@ -480,5 +607,16 @@ def get_order_details(
     }
 
 
-uvicorn.run(api, host="0.0.0.0", port=PORT)
-print("Sync service running on port 4000")
+# ===================================================
+# WORKERS > 1 runs that many worker processes for the branch,
+# each importing create_app. Also runs under gunicorn:
+# gunicorn -w N -k uvicorn.workers.UvicornWorker "app:create_app()"
+# (with WORKERS=N set, for the cache and the outbox)
+# ===================================================
+if __name__ == "__main__":
+    if WORKERS > 1:
+        uvicorn.run(
+            "app:create_app", factory=True, host="0.0.0.0", port=PORT, workers=WORKERS
+        )
+    else:
+        uvicorn.run(create_app(), host="0.0.0.0", port=PORT)
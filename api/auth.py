@@ -8,9 +8,12 @@
 # Novembro de 2025
 # ===================================================
 
+import os
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional
 
+from cache import LRUCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
@@ -25,11 +28,20 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Verified tokens, up to TOKEN_CACHE_SIZE (0 disables the cache)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+
 security = HTTPBearer()
 
 
+# Password hashing. Not used by the login check, so the context
+# is only built the first time something needs it.
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
 def authenticate_user(username: str, password: str) -> bool:
     if username != ADMIN_USERNAME:
         return False
@@ -49,7 +61,19 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
+# ===================================================
+# Verify the bearer token:
+# 1. A token verified before is served from token_cache
+# 2. Otherwise it is decoded and checked, and cached until
+# its exp claim, so an expired token is decoded (and
+# rejected) again
+# ===================================================
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    token = credentials.credentials
+    username = token_cache.get(token)
+    if username is not None:
+        return username
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -57,7 +81,6 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security))
     )
 
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
         if username is None:
@@ -68,6 +91,9 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security))
     if username != ADMIN_USERNAME:
         raise credentials_exception
 
+    token_cache.put(
+        token, username, token_cache.generation(), expires_at=payload.get("exp")
+    )
     return username
 
 
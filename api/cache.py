@@ -0,0 +1,134 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+PRODUCT_CACHE_ENABLED = os.getenv("PRODUCT_CACHE_ENABLED", "1") == "1"
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "1024"))
+
+
+# ===================================================
+# Bounded in-process LRU cache:
+# 1. get() moves a hit to the most recently used end; put()
+# evicts the least recently used entry when full
+# 2. Every invalidation bumps a generation counter. A reader
+# takes generation() before reading the database and passes it
+# to put(); if a write invalidated anything in between, the
+# value may be stale and is not stored
+# 3. Writers invalidate after their commit
+# 4. An entry may carry an expiry (epoch seconds); once past
+# it, the entry counts as a miss and is dropped
+# 5. With several workers, writes of the other processes can not
+# invalidate this cache: watch() a DataVersionWatcher and every
+# entry is dropped on the first lookup after any commit
+# ===================================================
+class LRUCache:
+    def __init__(self, max_size: int, enabled: bool = True):
+        self.mutex = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.enabled = enabled and max_size > 0
+        self.current_generation = 0
+        self.watcher = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+        self.expirations = 0
+        self.external_clears = 0
+
+    def watch(self, watcher):
+        with self.mutex:
+            self.watcher = watcher
+
+    def generation(self) -> int:
+        return self.current_generation
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+
+        with self.mutex:
+            if self.watcher is not None and self.watcher.changed():
+                # Committed elsewhere: any entry may be stale
+                self.current_generation += 1
+                self.invalidations += len(self.entries)
+                self.external_clears += 1
+                self.entries.clear()
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation: int, expires_at: Optional[float] = None):
+        if not self.enabled:
+            return
+
+        with self.mutex:
+            if generation != self.current_generation:
+                self.stale_fills += 1
+                return
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        if not self.enabled:
+            return
+
+        with self.mutex:
+            self.current_generation += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    # Drop every entry, e.g. after a bulk load replaced the table
+    def clear(self):
+        if not self.enabled:
+            return
+
+        with self.mutex:
+            self.current_generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        with self.mutex:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "stale_fills": self.stale_fills,
+                "expirations": self.expirations,
+                "external_clears": self.external_clears,
+            }
+
+
+# Product rows by id. Balances only change in update_product,
+# place_order and /notify, which invalidate after committing.
+product_cache = LRUCache(PRODUCT_CACHE_SIZE, enabled=PRODUCT_CACHE_ENABLED)
@@ -0,0 +1,34 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+
+# Branch identity: every instance of the API needs its own
+BRANCH_ID = os.getenv("BRANCH_ID", "bb5942cb28ff48f3420f0c13e9187746")
+PORT = int(os.getenv("PORT", "4444"))
+BASE_URL = os.getenv("BASE_URL", f"http://localhost:{PORT}")
+
+SYNC_SERVICE_BASE_URL = os.getenv("SYNC_SERVICE_BASE_URL", "http://localhost:4000")
+# Partition map: URL of every sync service partition, in partition
+# order (partition p at position p); one partition by default
+SYNC_SERVICE_URLS = [
+    url.strip()
+    for url in os.getenv("SYNC_SERVICE_URLS", SYNC_SERVICE_BASE_URL).split(",")
+    if url.strip()
+]
+# stream: events pushed on a WebSocket opened by the branch;
+# notify: the sync service POSTs them to BASE_URL/notify
+SYNC_DELIVERY = os.getenv("SYNC_DELIVERY", "stream")
+
+# Subscription and catch-up retry until the sync service answers
+STARTUP_MAX_BACKOFF_SECONDS = float(os.getenv("STARTUP_MAX_BACKOFF_SECONDS", "30"))
+
+# Worker processes serving this branch (one SQLite database); one
+# of them, the leader, runs subscription, outbox and catch-up
+WORKERS = int(os.getenv("WORKERS", "1"))
@@ -7,21 +7,241 @@
 # Computaçao Distribuída,
 # Novembro de 2025
 # ===================================================
+import os
+import queue
 import sqlite3
 
+from metrics import sqlite_commit_seconds, timed
 
-def get_db():
-    conn = sqlite3.connect("product_database.db")
+DATABASE = "product_database.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+
+
+# Hot path: GET /order/{id} lists the items of one request
+def add_product_request_request_id_index(conn):
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS product_request_request_id
+        ON product_request (request_id)
+        """)
+
+
+# Events from other branches already applied here, so a second
+# delivery of the same event is skipped. Pruned by the acker.
+def add_applied_event(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS applied_event (
+            id INTEGER PRIMARY KEY,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS applied_event_applied_at
+        ON applied_event (applied_at)
+        """)
+
+
+# Snapshots loaded from the sync service, with the last event id
+# each one reflects
+def add_snapshot(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            watermark INTEGER NOT NULL,
+            products INTEGER NOT NULL,
+            loaded_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+
+# Runtime state shared by the workers of the branch, e.g. the
+# startup progress of the leader served by GET /ready
+def add_runtime_state(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS runtime_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+
+# With a partitioned sync service every partition has its own
+# snapshot and watermark; snapshots loaded before are partition 0
+def add_snapshot_partition(conn):
+    snapshot_columns = [row[1] for row in conn.execute("PRAGMA table_info(snapshot)")]
+    if "sync_partition" not in snapshot_columns:
+        conn.execute(
+            "ALTER TABLE snapshot ADD COLUMN sync_partition INTEGER NOT NULL DEFAULT 0"
+        )
+
+
+# Idempotency key of each outbox event, sent with it: the sync
+# service stores a retried publish only once. Random, so keys
+# stay unique when a branch database is recreated.
+def add_outbox_event_key(conn):
+    conn.execute("ALTER TABLE outbox ADD COLUMN event_key TEXT NULL")
+    conn.execute(
+        "UPDATE outbox SET event_key = lower(hex(randomblob(16))) WHERE event_key IS NULL"
+    )
+
+
+# Outbox events the sync service refused for good (e.g. 421 from
+# a wrong partition map), moved aside so they do not block the
+# events behind them; kept for inspection and manual replay
+def add_outbox_dead_letter(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_dead_letter (
+            id INTEGER PRIMARY KEY,
+            operation TEXT NOT NULL,
+            sub INTEGER NOT NULL,
+            initial_balance INTEGER NOT NULL,
+            current_balance INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            created_at TEXT,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            event_key TEXT,
+            failed_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+
+# ===================================================
+# Versioned schema migrations:
+# 1. PRAGMA user_version holds the number of migrations applied
+# 2. Pending migrations run in order, each in its own transaction
+# 3. New migrations are only ever appended to this list
+# ===================================================
+MIGRATIONS = [
+    add_product_request_request_id_index,
+    add_applied_event,
+    add_snapshot,
+    add_runtime_state,
+    add_snapshot_partition,
+    add_outbox_event_key,
+    add_outbox_dead_letter,
+]
+
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Migration {number} applied: {migration.__name__}")
+
+
+# Connection that times every commit (sqlite_commit_duration_seconds)
+class TimedConnection(sqlite3.Connection):
+    def commit(self):
+        with timed(sqlite_commit_seconds):
+            super().commit()
+
+
+# ===================================================
+# Open a tuned connection:
+# 1. busy_timeout makes a writer wait for the lock instead of
+# failing at once with "database is locked"
+# 2. synchronous=NORMAL is durable with WAL and skips the fsync
+# on every commit
+# 3. Up to DB_CACHED_STATEMENTS prepared statements are reused
+# Usable from any thread, but by one thread at a time.
+# ===================================================
+def connect(database: str = DATABASE):
+    conn = sqlite3.connect(
+        database,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+        factory=TimedConnection,
+    )
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
     conn.row_factory = sqlite3.Row
+    return conn
+
+
+# ===================================================
+# Pool of open connections shared by the request threads:
+# 1. acquire() reuses the most recently returned connection
+# (warm page and statement caches) or opens a new one
+# 2. release() rolls back whatever the request left open and
+# keeps up to `size` idle connections, closing the rest
+# A request holds its connection from the dependency until the
+# response is sent, even when FastAPI moves it between threads.
+# ===================================================
+class ConnectionPool:
+    def __init__(self, database: str, size: int):
+        self.database = database
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect(self.database)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self.idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+
+
+pool = ConnectionPool(DATABASE, DB_POOL_SIZE)
+
+
+# ===================================================
+# Detects commits made by any other connection, in this or in
+# another worker process: PRAGMA data_version changes on the
+# watcher's connection whenever someone else commits. Cheap
+# enough to check on every cache lookup. Not thread-safe: the
+# caller serializes the calls.
+# ===================================================
+class DataVersionWatcher:
+    def __init__(self, database: str = DATABASE):
+        self.conn = connect(database)
+        self.version = self.read()
+
+    def read(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    # True when someone committed since the last call
+    def changed(self):
+        version = self.read()
+        if version == self.version:
+            return False
+        self.version = version
+        return True
+
+
+def get_db():
+    conn = pool.acquire()
 
     try:
         yield conn
     finally:
-        conn.close()
+        pool.release(conn)
 
 
 def start_database():
-    conn = sqlite3.connect("product_database.db")
+    conn = connect()
+    # Readers do not block the writer (and vice versa); the mode is
+    # stored in the database file
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
 
     conn.execute("""
         CREATE TABLE IF NOT EXISTS product (
@@ -47,5 +267,20 @@ def start_database():
             FOREIGN KEY (product_id) REFERENCES product(id)
         )
         """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operation TEXT NOT NULL,
+            sub INTEGER NOT NULL,
+            initial_balance INTEGER NOT NULL,
+            current_balance INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+        """)
     conn.commit()
+
+    migrate(conn)
     conn.close()
@@ -8,85 +8,206 @@
 # Novembro de 2025
 # ===================================================
 
+import json
+import os
 from sqlite3 import Connection, Cursor
+from typing import Callable, Optional
 
-import requests
-from fastapi.exceptions import HTTPException
+from cache import product_cache
+from http_client import SESSION_TIMEOUT, session, sync_call_seconds
+from metrics import timed
 from models import NotifyIn
-from starlette.status import HTTP_404_NOT_FOUND
+from partition import partition_of
+from snapshot import snapshot_watermark
 
+CATCH_UP_PAGE_SIZE = int(os.getenv("CATCH_UP_PAGE_SIZE", "500"))
 
-def publish_event(
+
+def publish_events(
     SYNC_SERVICE_BASE_URL: str,
     BRANCH_ID: str,
-    operation: str,
-    sub: int,
-    initial_balance: int = 0,
-    current_balance: int = 0,
-    delta: int = 0,
+    events: list,
+    timeout=SESSION_TIMEOUT,
 ):
     event_data = {
         "branch_id": BRANCH_ID,
-        "operation": operation,
-        "sub": sub,
-        "initial_balance": initial_balance,
-        "current_balance": current_balance,
-        "delta": delta,
+        "events": [
+            {
+                "operation": event["operation"],
+                "sub": event["sub"],
+                "initial_balance": event["initial_balance"],
+                "current_balance": event["current_balance"],
+                "delta": event["delta"],
+                "event_key": event["event_key"],
+            }
+            for event in events
+        ],
     }
 
-    result = requests.post(
-        f"{SYNC_SERVICE_BASE_URL}/event/publish",
-        json=event_data,
-    )
+    with timed(sync_call_seconds, call="publish_batch"):
+        result = session.post(
+            f"{SYNC_SERVICE_BASE_URL}/event/publish-batch",
+            json=event_data,
+            timeout=timeout,
+        )
     return result
 
 
-def consume_create(
-    db: Connection, cursor: Cursor, notify_data: NotifyIn, BRANCH_ID: str
-):
-    product = cursor.execute(
-        "SELECT id FROM product WHERE id = ?", (notify_data.sub,)
-    ).fetchone()
-    if product is not None:
-        print("Product already exists. Ignore")
-        return
-    print(f"Product {notify_data.sub} not foun in brach {BRANCH_ID}. Start syncing...")
-    cursor.execute(
-        "INSERT INTO product (id, current_balance) VALUES (?, ?)",
-        (notify_data.sub, notify_data.initial_balance),
-    )
-    db.commit()
-    print("Sync OK.")
-
-    consume_request = requests.patch(
-        f"http://localhost:4000/event/consume/{notify_data.event_consumer_id}"
-    )
-
-    print(consume_request.status_code)
-
-
-def consume_update(
-    db: Connection, cursor: Cursor, notify_data: NotifyIn, BRANCH_ID: str
+# ===================================================
+# Apply a list of events from other branches, without committing:
+# 1. CREATE inserts the product unless it already exists
+# 2. UPDATE adds the delta to the current balance
+# 3. Each event id is recorded in applied_event, in the same
+# transaction: an event delivered twice (by /notify and by
+# the catch-up, or again after a crash before its ack) is
+# applied only once
+# 4. Events up to the watermark of a loaded snapshot of their
+# partition are already reflected in it and are skipped. The
+# watermarks are read after the first write, i.e. holding the
+# write lock, so a snapshot load can not commit in between
+# 5. A coalesced UPDATE only adds the deltas of its originals
+# not applied yet, and records them as applied too, so an
+# original delivered before (or after) it is applied once
+# The caller commits the whole list in one transaction.
+# Returns the ids of the applied events and of the UPDATEs whose
+# product is not known yet (left non-consumed).
+# ===================================================
+def apply_events(cursor: Cursor, events: list, BRANCH_ID: str):
+    applied, missing = [], []
+    watermarks = {}
+
+    def watermark(event_id: int):
+        partition = partition_of(event_id)
+        if partition not in watermarks:
+            watermarks[partition] = snapshot_watermark(cursor, partition)
+        return watermarks[partition]
+
+    for event in events:
+        if event.publisher_branch_id == BRANCH_ID:
+            print("Ignore event from own branch")
+            continue
+
+        first_delivery = cursor.execute(
+            "INSERT OR IGNORE INTO applied_event (id) VALUES (?)",
+            (event.event_consumer_id,),
+        ).rowcount
+        if not first_delivery or event.event_consumer_id <= watermark(
+            event.event_consumer_id
+        ):
+            # Already applied: only the ack is still missing
+            applied.append(event.event_consumer_id)
+            continue
+
+        if event.operation == "CREATE":
+            cursor.execute(
+                "INSERT OR IGNORE INTO product (id, current_balance) VALUES (?, ?)",
+                (event.sub, event.initial_balance),
+            )
+        elif event.operation == "UPDATE":
+            delta, originals = event.delta, []
+            if event.coalesced is not None:
+                delta = 0
+                for original_id, original_delta in event.coalesced:
+                    if cursor.execute(
+                        "INSERT OR IGNORE INTO applied_event (id) VALUES (?)",
+                        (original_id,),
+                    ).rowcount:
+                        originals.append(original_id)
+                        if original_id > watermark(original_id):
+                            delta += original_delta
+
+            updated = cursor.execute(
+                "UPDATE product SET current_balance = current_balance + ? WHERE id = ?",
+                (delta, event.sub),
+            ).rowcount
+            if updated == 0:
+                print(f"Product {event.sub} not found in branch {BRANCH_ID}")
+                cursor.executemany(
+                    "DELETE FROM applied_event WHERE id = ?",
+                    [(event_id,) for event_id in (event.event_consumer_id, *originals)],
+                )
+                missing.append(event.event_consumer_id)
+                continue
+
+        applied.append(event.event_consumer_id)
+
+    return applied, missing
+
+
+def consume_events(
+    SYNC_SERVICE_BASE_URL: str,
+    BRANCH_ID: str,
+    event_ids: list,
+    timeout=SESSION_TIMEOUT,
 ):
-    product = cursor.execute(
-        "SELECT current_balance FROM product WHERE id = ?", (notify_data.sub,)
-    ).fetchone()
-
-    if product is None:
-        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Product not found")
-
-    print(f"Found product {notify_data.sub} in branch {BRANCH_ID}. Start updating...")
-    current_balance = product[0]
-
-    cursor.execute(
-        "UPDATE product SET current_balance = ? WHERE id = ?",
-        (current_balance + notify_data.delta, notify_data.sub),
-    )
-    db.commit()
-    print("Sync OK.")
+    with timed(sync_call_seconds, call="consume"):
+        result = session.patch(
+            f"{SYNC_SERVICE_BASE_URL}/event/consume",
+            json={"branch_id": BRANCH_ID, "event_ids": event_ids},
+            timeout=timeout,
+        )
+    return result
 
-    consume_request = requests.patch(
-        f"http://localhost:4000/event/consume/{notify_data.event_consumer_id}"
-    )
 
-    print(consume_request.status_code)
+# ===================================================
+# Catch-up of non-consumed events, one page at a time:
+# 1. Ask the sync service for the next page after the last id seen
+# 2. Apply the whole page (CREATE and UPDATE) in one transaction
+# and invalidate the cached products it touched
+# 3. Hand the page's applied event ids to `ack` (the acker queue)
+# 4. Report the progress to `on_page(applied, last_id)`; a retry
+# resumes with after_id = the last id reported
+# Memory stays bounded by CATCH_UP_PAGE_SIZE events.
+# ===================================================
+def catch_up(
+    db: Connection,
+    SYNC_SERVICE_BASE_URL: str,
+    BRANCH_ID: str,
+    ack: Callable,
+    after_id: int = 0,
+    on_page: Optional[Callable] = None,
+):
+    cursor = db.cursor()
+    total = 0
+
+    while True:
+        with timed(sync_call_seconds, call="non_consumed"):
+            response = session.get(
+                f"{SYNC_SERVICE_BASE_URL}/event/non-consumed/{BRANCH_ID}",
+                params={"after_id": after_id, "limit": CATCH_UP_PAGE_SIZE},
+                timeout=SESSION_TIMEOUT,
+            )
+        response.raise_for_status()
+        page = response.json()
+        if not page:
+            break
+
+        events = [
+            NotifyIn(
+                event_consumer_id=event["id"],
+                publisher_branch_id=event["publisher_id"],
+                operation=event["operation"],
+                sub=event["sub"],
+                initial_balance=event["initial_balance"],
+                current_balance=event["current_balance"],
+                delta=event["delta"],
+                coalesced=(
+                    json.loads(event["coalesced"]) if event.get("coalesced") else None
+                ),
+            )
+            for event in page
+        ]
+        applied, missing = apply_events(cursor, events, BRANCH_ID)
+        db.commit()
+        product_cache.invalidate({event.sub for event in events})
+        ack(applied)
+
+        total += len(applied)
+        after_id = page[-1]["id"]
+        print(f"Catch-up: {total} events applied, last id {after_id}")
+        if on_page is not None:
+            on_page(len(applied), after_id)
+        if len(page) < CATCH_UP_PAGE_SIZE:
+            break
+
+    return total
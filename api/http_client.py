@@ -0,0 +1,54 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+
+import httpx
+import requests
+from metrics import Histogram
+from requests.adapters import HTTPAdapter
+
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "5"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "2"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+# ===================================================
+# Shared keep-alive clients for the calls to the sync service:
+# 1. async_client is used by the async endpoints; requests wait
+# on the event loop instead of holding a threadpool worker
+# 2. session is used by the background threads (outbox,
+# acker) and the startup catch-up
+# Both reuse TCP connections and always have a timeout.
+# ===================================================
+async_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+)
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=HTTP_MAX_KEEPALIVE_CONNECTIONS))
+session.mount("https://", HTTPAdapter(pool_maxsize=HTTP_MAX_KEEPALIVE_CONNECTIONS))
+
+# (connect, read) timeout for the session's calls
+SESSION_TIMEOUT = (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_TIMEOUT_SECONDS)
+
+sync_call_seconds = Histogram(
+    "sync_service_call_duration_seconds",
+    "Time of each call to the sync service, by call.",
+    ("call",),
+)
+
+
+async def close_clients():
+    await async_client.aclose()
+    session.close()
@@ -0,0 +1,93 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from database import DATABASE
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no flock, so only a single worker is supported and
+    # it is always the leader
+    fcntl = None
+
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "5"))
+
+
+# Exclusive lock shared by the workers of this branch; blocks
+# until no other worker holds it
+@contextmanager
+def file_lock(path: str):
+    with open(path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# ===================================================
+# Leader election among the workers of one branch:
+# 1. The leader is the worker holding an exclusive flock on
+# `path`; the file stays open (and locked) for the life of the
+# process, and the OS releases it when the process dies
+# 2. A worker that does not get the lock retries every
+# LEADER_RETRY_SECONDS in background, so another worker takes
+# over when the leader exits
+# 3. on_elected runs once, in the worker that becomes leader
+# ===================================================
+class LeaderElection:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_file = None
+        self.is_leader = False
+
+    def try_acquire(self):
+        lock_file = open(self.path, "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+        self.lock_file = lock_file
+        return True
+
+    def become_leader(self, on_elected: Callable):
+        self.is_leader = True
+        print(f"Worker {os.getpid()} is the branch leader")
+        on_elected()
+
+    def wait_forever(self, on_elected: Callable):
+        while not self.try_acquire():
+            time.sleep(LEADER_RETRY_SECONDS)
+        self.become_leader(on_elected)
+
+    def start(self, on_elected: Callable):
+        if self.try_acquire():
+            self.become_leader(on_elected)
+            return
+
+        print(f"Worker {os.getpid()} is a follower")
+        threading.Thread(
+            target=self.wait_forever,
+            args=(on_elected,),
+            name="leader-election",
+            daemon=True,
+        ).start()
+
+
+leader = LeaderElection(f"{DATABASE}.leader")
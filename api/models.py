@@ -7,7 +7,7 @@
 # Computaçao Distribuída,
 # Novembro de 2025
 # ===================================================
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -25,6 +25,8 @@ class NotifyIn(BaseModel):
     initial_balance: int
     current_balance: int
     delta: int
+    # [event id, delta] of the UPDATEs coalesced into this one
+    coalesced: Optional[List[List[int]]] = None
 
 
 class OrderItem(BaseModel):
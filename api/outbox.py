@@ -0,0 +1,260 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+import threading
+import time
+from sqlite3 import Cursor
+from typing import Callable, Optional
+
+from config import WORKERS
+from database import DataVersionWatcher, connect
+from event_handler import publish_events
+from partition import partition_sql
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "60"))
+OUTBOX_PUBLISH_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_PUBLISH_TIMEOUT_SECONDS", "5"))
+# Partition of an outbox event, as partition_of(sub)
+SUB_PARTITION = partition_sql("sub")
+# With several workers, how often the dispatcher checks whether
+# another worker committed (possibly new outbox events)
+OUTBOX_WORKER_CHECK_SECONDS = 0.05
+
+
+# Wakes the dispatcher of every partition: each one has its own
+# event, so one partition clearing it never hides a write from
+# another
+class DispatcherWakeup:
+    def __init__(self):
+        self.events = []
+
+    def register(self):
+        event = threading.Event()
+        self.events.append(event)
+        return event
+
+    def set(self):
+        for event in self.events:
+            event.set()
+
+
+wake_dispatcher = DispatcherWakeup()
+
+
+# ===================================================
+# Enqueue an event in the local outbox.
+# Must be called inside the same transaction as the
+# product change, the caller commits both together.
+# ===================================================
+def enqueue_event(
+    cursor: Cursor,
+    operation: str,
+    sub: int,
+    initial_balance: int = 0,
+    current_balance: int = 0,
+    delta: int = 0,
+):
+    cursor.execute(
+        """
+        INSERT INTO outbox (operation, sub, initial_balance, current_balance, delta, event_key)
+        VALUES (?, ?, ?, ?, ?, lower(hex(randomblob(16))))
+        """,
+        (operation, sub, initial_balance, current_balance, delta),
+    )
+
+
+# A 4xx answer other than a timeout, a rate limit or a lost
+# subscription fails the same way on every retry
+def permanent_failure(status_code: int):
+    return 400 <= status_code < 500 and status_code not in (404, 408, 429)
+
+
+# Move a refused batch to outbox_dead_letter, out of the way of
+# the events behind it
+def dead_letter(cursor: Cursor, last_id: int, error: str, partition: int):
+    columns = "id, operation, sub, initial_balance, current_balance, delta, created_at, attempts, last_error, event_key"
+    cursor.execute(
+        f"""
+        INSERT OR REPLACE INTO outbox_dead_letter ({columns})
+        SELECT id, operation, sub, initial_balance, current_balance, delta, created_at, attempts + 1, ?, event_key
+        FROM outbox WHERE id <= ? AND {SUB_PARTITION} = ?
+        """,
+        (error, last_id, partition),
+    )
+    return cursor.execute(
+        f"DELETE FROM outbox WHERE id <= ? AND {SUB_PARTITION} = ?",
+        (last_id, partition),
+    ).rowcount
+
+
+# ===================================================
+# Send the oldest pending events of one sync service partition
+# (the events of its products) to it, in order, with one
+# /event/publish-batch call. An order's events are committed
+# together, so they travel in the same batch, or in one batch
+# per partition.
+# 1. Each event carries its event_key: a batch retried after a
+# timeout (but stored by the sync service) is not stored twice
+# 2. Failures are retried, except a permanent 4xx answer: that
+# batch is dead-lettered (outbox_dead_letter, GET /outbox/stats)
+# 3. A 404 means the sync service lost the branch's subscription
+# (e.g. its database was recreated): the branch subscribes again
+# with `subscribe` and the batch is retried
+# Returns (sent, failed).
+# ===================================================
+def drain_outbox(
+    conn,
+    SYNC_SERVICE_BASE_URL: str,
+    BRANCH_ID: str,
+    partition: int = 0,
+    subscribe: Optional[Callable] = None,
+):
+    cursor = conn.cursor()
+    pending = cursor.execute(
+        f"SELECT * FROM outbox WHERE {SUB_PARTITION} = ? ORDER BY id LIMIT ?",
+        (partition, OUTBOX_BATCH_SIZE),
+    ).fetchall()
+
+    if not pending:
+        return 0, False
+
+    error = None
+    try:
+        result = publish_events(
+            SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
+            BRANCH_ID=BRANCH_ID,
+            events=pending,
+            timeout=OUTBOX_PUBLISH_TIMEOUT_SECONDS,
+        )
+        if result.status_code != 200:
+            error = f"{result.status_code} {result.text}"
+            if permanent_failure(result.status_code):
+                moved = dead_letter(cursor, pending[-1]["id"], error, partition)
+                conn.commit()
+                print(f"Outbox publish refused, {moved} events dead-lettered: {error}")
+                return 0, False
+            if result.status_code == 404 and subscribe is not None:
+                print(f"Outbox publish refused, subscribing again: {error}")
+                subscribe(SYNC_SERVICE_BASE_URL, partition=partition)
+    except Exception as e:
+        error = str(e)
+
+    if error is not None:
+        cursor.execute(
+            f"UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id <= ? AND {SUB_PARTITION} = ?",
+            (error, pending[-1]["id"], partition),
+        )
+        conn.commit()
+        print(f"Outbox publish failed: {error}")
+        return 0, True
+
+    cursor.execute(
+        f"DELETE FROM outbox WHERE id <= ? AND {SUB_PARTITION} = ?",
+        (pending[-1]["id"], partition),
+    )
+    conn.commit()
+    return len(pending), False
+
+
+def outbox_stats(db):
+    pending, attempts, last_error = db.execute("""
+        SELECT COUNT(*), MAX(attempts),
+            (SELECT last_error FROM outbox WHERE last_error IS NOT NULL ORDER BY id LIMIT 1)
+        FROM outbox
+        """).fetchone()
+    dead_letters, last_dead_letter_error = db.execute("""
+        SELECT COUNT(*),
+            (SELECT last_error FROM outbox_dead_letter ORDER BY failed_at DESC, id DESC LIMIT 1)
+        FROM outbox_dead_letter
+        """).fetchone()
+    return {
+        "pending": pending,
+        "max_attempts": attempts or 0,
+        "last_error": last_error,
+        "dead_letters": dead_letters,
+        "last_dead_letter_error": last_dead_letter_error,
+    }
+
+
+# Wait for new events: writes of this process set wake_dispatcher;
+# writes of the other workers can not, so with several workers a
+# commit seen by `watcher` wakes the dispatcher too
+def wait_for_events(wakeup: threading.Event, watcher):
+    if watcher is None:
+        wakeup.wait(OUTBOX_POLL_SECONDS)
+        return
+
+    deadline = time.monotonic() + OUTBOX_POLL_SECONDS
+    while time.monotonic() < deadline:
+        if wakeup.wait(OUTBOX_WORKER_CHECK_SECONDS) or watcher.changed():
+            return
+
+
+def dispatch_forever(
+    SYNC_SERVICE_BASE_URL: str,
+    BRANCH_ID: str,
+    partition: int,
+    subscribe: Optional[Callable] = None,
+):
+    conn = connect()
+    wakeup = wake_dispatcher.register()
+    watcher = DataVersionWatcher() if WORKERS > 1 else None
+    backoff = 1.0
+
+    while True:
+        wakeup.clear()
+        if watcher is not None:
+            # Commits from now on wake the next wait
+            watcher.changed()
+        try:
+            sent, failed = drain_outbox(
+                conn, SYNC_SERVICE_BASE_URL, BRANCH_ID, partition, subscribe
+            )
+        except Exception as e:
+            print(f"Outbox dispatcher error: {str(e)}")
+            sent, failed = 0, True
+
+        if failed:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, OUTBOX_MAX_BACKOFF_SECONDS)
+            continue
+        backoff = 1.0
+
+        if sent < OUTBOX_BATCH_SIZE:
+            wait_for_events(wakeup, watcher)
+
+
+# ===================================================
+# Background dispatchers, one per sync service partition:
+# 1. Each drains the outbox events of its partition's products
+# to that partition in batches
+# 2. Retries with exponential backoff on failure; a partition
+# that is down only holds back the events of its own products
+# 3. Wakes up right after a write commits new events, in this
+# worker or (WORKERS > 1) in any other
+# Runs in the leader worker only, so events are published once
+# and, per product, in order. `subscribe(SYNC_SERVICE_BASE_URL,
+# partition=...)` subscribes the branch again after a 404.
+# ===================================================
+def start_dispatcher(
+    SYNC_SERVICE_URLS: list, BRANCH_ID: str, subscribe: Optional[Callable] = None
+):
+    threads = []
+    for partition, SYNC_SERVICE_BASE_URL in enumerate(SYNC_SERVICE_URLS):
+        thread = threading.Thread(
+            target=dispatch_forever,
+            args=(SYNC_SERVICE_BASE_URL, BRANCH_ID, partition, subscribe),
+            name=f"outbox-dispatcher-{partition}",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -0,0 +1,47 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+from typing import Callable
+
+from config import SYNC_SERVICE_URLS
+
+SYNC_PARTITIONS = len(SYNC_SERVICE_URLS)
+
+
+# ===================================================
+# Routing to the sync service partitions (SYNC_SERVICE_URLS):
+# 1. A product belongs to partition product_id % SYNC_PARTITIONS,
+# which holds its locks and its events
+# 2. Partition p numbers its events with ids where
+# id % SYNC_PARTITIONS == p, so an event id (for an ack) is
+# routed the same way as a product id
+# Must match SYNC_PARTITIONS/SYNC_PARTITION of the partitions.
+# ===================================================
+def partition_of(key: int):
+    return key % SYNC_PARTITIONS
+
+
+# partition_of in SQL: SQLite's % keeps the sign of the key
+# (-3 % 2 = -1) where Python's does not (1), so a negative id is
+# brought back into range the same way
+def partition_sql(column: str):
+    return f"(({column} % {SYNC_PARTITIONS}) + {SYNC_PARTITIONS}) % {SYNC_PARTITIONS}"
+
+
+def partition_url(key: int):
+    return SYNC_SERVICE_URLS[partition_of(key)]
+
+
+# {partition: [items]} by the product or event id given by `key`,
+# keeping the items' order in each partition
+def group_by_partition(items, key: Callable):
+    groups = {}
+    for item in items:
+        groups.setdefault(partition_of(key(item)), []).append(item)
+    return groups
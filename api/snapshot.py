@@ -0,0 +1,157 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import json
+import os
+from sqlite3 import Connection
+
+from cache import product_cache
+from http_client import SESSION_TIMEOUT, session
+from partition import partition_sql
+from starlette.status import HTTP_409_CONFLICT
+
+# A branch that already has products loads a snapshot only when
+# it is this many events behind; a branch without products always does
+SNAPSHOT_MIN_PENDING_EVENTS = int(os.getenv("SNAPSHOT_MIN_PENDING_EVENTS", "10000"))
+SNAPSHOT_PARSE_BATCH = 10000
+
+
+# Last event id of a partition reflected by a snapshot loaded
+# here (0 when none)
+def snapshot_watermark(db: Connection, partition: int):
+    return (
+        db.execute(
+            "SELECT MAX(watermark) FROM snapshot WHERE sync_partition = ?",
+            (partition,),
+        ).fetchone()[0]
+        or 0
+    )
+
+
+def consume_through(SYNC_SERVICE_BASE_URL: str, BRANCH_ID: str, watermark: int):
+    result = session.patch(
+        f"{SYNC_SERVICE_BASE_URL}/event/consume-through",
+        json={"branch_id": BRANCH_ID, "watermark": watermark},
+        timeout=SESSION_TIMEOUT,
+    )
+    result.raise_for_status()
+    return result.json()["consumed"]
+
+
+def parse_balances(batch: list):
+    return json.loads(b"[" + b",".join(batch) + b"]")
+
+
+# [product_id, balance] pairs from the snapshot lines (bytes), parsed
+# SNAPSHOT_PARSE_BATCH lines per json.loads call
+def balances(lines):
+    batch = []
+    for line in lines:
+        if line:
+            batch.append(line)
+        if len(batch) == SNAPSHOT_PARSE_BATCH:
+            yield from parse_balances(batch)
+            batch = []
+    if batch:
+        yield from parse_balances(batch)
+
+
+# Upsert the balances of a partition's snapshot and record its
+# watermark, inside the caller's transaction
+def load_snapshot(db: Connection, partition: int, header: dict, lines):
+    loaded = db.executemany(
+        """
+        INSERT INTO product (id, current_balance) VALUES (?, ?)
+        ON CONFLICT (id) DO UPDATE SET current_balance = excluded.current_balance
+        """,
+        balances(lines),
+    ).rowcount
+    if loaded != header["products"]:
+        raise ValueError(
+            f"Snapshot truncated: {loaded} of {header['products']} products"
+        )
+
+    db.execute(
+        "INSERT INTO snapshot (watermark, products, sync_partition) VALUES (?, ?, ?)",
+        (header["watermark"], header["products"], partition),
+    )
+
+
+# ===================================================
+# Bootstrap from the sync service snapshot (GET /snapshot):
+# 1. Take the write lock first, then check the outbox is empty:
+# every local write and every /notify applied so far is then
+# already in the snapshot requested next, and writes arriving
+# now wait and apply on top of it
+# 2. Read the header; load only when the branch has no products of
+# the partition yet or is at least SNAPSHOT_MIN_PENDING_EVENTS
+# events behind
+# 3. Upsert every balance and record the watermark in the same
+# transaction
+# 4. Mark the branch's events up to the watermark consumed on the
+# sync service, so only the events after it are replayed
+# apply_events skips events up to the recorded watermark, so an
+# older /notify delivery is not applied twice.
+# With several sync service partitions, each one is bootstrapped
+# on its own: it only holds the balances of its products.
+# Returns the watermark to resume the catch-up from.
+# ===================================================
+def bootstrap_from_snapshot(
+    db: Connection, SYNC_SERVICE_BASE_URL: str, BRANCH_ID: str, partition: int = 0
+):
+    watermark = snapshot_watermark(db, partition)
+    if watermark:
+        # A crash may have happened before the previous consume-through
+        consume_through(SYNC_SERVICE_BASE_URL, BRANCH_ID, watermark)
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if db.execute("SELECT 1 FROM outbox LIMIT 1").fetchone():
+            print("Snapshot skipped: local events not published yet")
+            db.rollback()
+            return watermark
+        # Only the partition's own products count: another
+        # partition's snapshot may have been loaded just before
+        has_products = db.execute(
+            f"SELECT 1 FROM product WHERE {partition_sql('id')} = ? LIMIT 1",
+            (partition,),
+        ).fetchone()
+
+        with session.get(
+            f"{SYNC_SERVICE_BASE_URL}/snapshot",
+            params={"branch_id": BRANCH_ID},
+            timeout=SESSION_TIMEOUT,
+            stream=True,
+        ) as response:
+            if response.status_code == HTTP_409_CONFLICT:
+                print(f"Snapshot not available: {response.json()['detail']}")
+                db.rollback()
+                return watermark
+            response.raise_for_status()
+
+            lines = response.iter_lines()
+            header = json.loads(next(lines))
+            behind = header["pending"] >= SNAPSHOT_MIN_PENDING_EVENTS
+            if not header["products"] or (has_products and not behind):
+                db.rollback()
+                return watermark
+
+            load_snapshot(db, partition, header, lines)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    product_cache.clear()
+    print(
+        f"Snapshot loaded: {header['products']} products "
+        f"at event {header['watermark']}"
+    )
+    consume_through(SYNC_SERVICE_BASE_URL, BRANCH_ID, header["watermark"])
+    return header["watermark"]
@@ -0,0 +1,217 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import functools
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from acker import ack_events
+from config import STARTUP_MAX_BACKOFF_SECONDS, SYNC_DELIVERY
+from database import connect
+from event_handler import catch_up
+from http_client import SESSION_TIMEOUT, session
+from outbox import start_dispatcher
+from partition import SYNC_PARTITIONS
+from snapshot import bootstrap_from_snapshot
+from stream import start_stream, stream_states
+
+
+@dataclass
+class StartupState:
+    subscribed: bool = False
+    bootstrapped: bool = False
+    # Per sync service partition
+    snapshot_watermarks: dict = field(default_factory=dict)
+    catch_up_started: bool = False
+    caught_up: bool = False
+    applied: int = 0
+    last_event_ids: dict = field(default_factory=dict)
+    attempts: int = 0
+    last_error: Optional[str] = None
+    started_at: float = field(default_factory=time.monotonic)
+    ready_after: Optional[float] = None
+
+    def record_page(self, partition: int, applied: int, last_event_id: int):
+        self.applied += applied
+        self.last_event_ids[partition] = last_event_id
+
+    def to_dict(self):
+        return {
+            "ready": self.caught_up,
+            "subscribed": self.subscribed,
+            "bootstrapped": self.bootstrapped,
+            "snapshot_watermarks": self.snapshot_watermarks,
+            "caught_up": self.caught_up,
+            "applied": self.applied,
+            "last_event_ids": self.last_event_ids,
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+            "ready_after": self.ready_after,
+            "delivery": SYNC_DELIVERY,
+            "stream": [stream_state.to_dict() for stream_state in stream_states],
+            "leader_pid": os.getpid(),
+        }
+
+    # Shared with the other workers of the branch (GET /ready).
+    # Best effort: a failure only delays what they see
+    def save(self, conn):
+        try:
+            conn.execute(
+                """
+                INSERT INTO runtime_state (name, value) VALUES ('startup', ?)
+                ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+                """,
+                (json.dumps(self.to_dict()),),
+            )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Startup state not saved: {str(e)}")
+
+
+startup_state = StartupState()
+
+
+# Startup progress saved by the leader, for the other workers
+# (None until a leader saved it)
+def load_startup_state(db):
+    row = db.execute(
+        "SELECT value FROM runtime_state WHERE name = 'startup'"
+    ).fetchone()
+    return json.loads(row["value"]) if row else None
+
+
+# The sync service at position `partition` of the partition map
+# must be that partition, of as many partitions
+def check_partition(SYNC_SERVICE_BASE_URL: str, partition: int):
+    result = session.get(f"{SYNC_SERVICE_BASE_URL}/partition", timeout=SESSION_TIMEOUT)
+    result.raise_for_status()
+    expected = {"partition": partition, "partitions": SYNC_PARTITIONS}
+    if result.json() != expected:
+        raise ValueError(
+            f"Partition map mismatch at {SYNC_SERVICE_BASE_URL}: "
+            f"expected {expected}, got {result.json()}"
+        )
+
+
+def subscribe(
+    SYNC_SERVICE_BASE_URL: str, BRANCH_ID: str, BASE_URL: str, partition: int = 0
+):
+    check_partition(SYNC_SERVICE_BASE_URL, partition)
+    # A streaming branch is never called back, so it sends no URL
+    branch_url = BASE_URL if SYNC_DELIVERY == "notify" else None
+    result = session.post(
+        f"{SYNC_SERVICE_BASE_URL}/subscribe",
+        json={"branch_id": BRANCH_ID, "branch_url": branch_url},
+        timeout=SESSION_TIMEOUT,
+    )
+    result.raise_for_status()
+    print("Subscription result: ", result.status_code, result.json())
+
+
+def sync_until_ready(SYNC_SERVICE_URLS: list, BRANCH_ID: str, BASE_URL: str):
+    conn = connect()
+    backoff = 1.0
+    # Replaces whatever a previous leader left
+    startup_state.save(conn)
+
+    def on_page(partition: int, applied: int, last_event_id: int):
+        startup_state.record_page(partition, applied, last_event_id)
+        startup_state.save(conn)
+
+    while not startup_state.caught_up:
+        startup_state.attempts += 1
+        try:
+            if not startup_state.subscribed:
+                for partition, SYNC_SERVICE_BASE_URL in enumerate(SYNC_SERVICE_URLS):
+                    subscribe(SYNC_SERVICE_BASE_URL, BRANCH_ID, BASE_URL, partition)
+                startup_state.subscribed = True
+                start_dispatcher(
+                    SYNC_SERVICE_URLS=SYNC_SERVICE_URLS,
+                    BRANCH_ID=BRANCH_ID,
+                    subscribe=functools.partial(
+                        subscribe, BRANCH_ID=BRANCH_ID, BASE_URL=BASE_URL
+                    ),
+                )
+                if SYNC_DELIVERY == "stream":
+                    start_stream(
+                        SYNC_SERVICE_URLS=SYNC_SERVICE_URLS,
+                        BRANCH_ID=BRANCH_ID,
+                        startup_state=startup_state,
+                    )
+
+            for partition, SYNC_SERVICE_BASE_URL in enumerate(SYNC_SERVICE_URLS):
+                if partition in startup_state.snapshot_watermarks:
+                    continue
+                watermark = bootstrap_from_snapshot(
+                    db=conn,
+                    SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
+                    BRANCH_ID=BRANCH_ID,
+                    partition=partition,
+                )
+                startup_state.snapshot_watermarks[partition] = watermark
+                startup_state.last_event_ids[partition] = max(
+                    startup_state.last_event_ids.get(partition, 0), watermark
+                )
+            startup_state.bootstrapped = True
+
+            startup_state.catch_up_started = True
+            for partition, SYNC_SERVICE_BASE_URL in enumerate(SYNC_SERVICE_URLS):
+                catch_up(
+                    db=conn,
+                    SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
+                    BRANCH_ID=BRANCH_ID,
+                    ack=ack_events,
+                    after_id=startup_state.last_event_ids.get(partition, 0),
+                    on_page=functools.partial(on_page, partition),
+                )
+            startup_state.ready_after = time.monotonic() - startup_state.started_at
+            startup_state.caught_up = True
+            startup_state.save(conn)
+            print("non-consumed events applied: ", startup_state.applied)
+        except Exception as e:
+            conn.rollback()
+            startup_state.last_error = str(e)
+            print(f"Startup sync failed, retrying in {backoff}s: {str(e)}")
+            startup_state.save(conn)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, STARTUP_MAX_BACKOFF_SECONDS)
+
+    conn.close()
+
+
+# ===================================================
+# Background startup synchronization, so the branch serves
+# requests right away and does not depend on the sync service
+# being up:
+# 1. Subscribe on every sync service partition, then start the
+# outbox dispatchers and, with SYNC_DELIVERY=stream, the event
+# streams (stream.py)
+# 2. Load each partition's snapshot when the branch is new or far
+# behind (see snapshot.py)
+# 3. Replay each partition's non-consumed events page by page,
+# after its snapshot watermark (resuming after the last page
+# applied when a retry is needed)
+# 4. Retry with exponential backoff until all are done
+# Progress is reported by GET /ready, and saved in runtime_state
+# for the other workers. Runs in the leader worker only.
+# ===================================================
+def start_startup_sync(SYNC_SERVICE_URLS: list, BRANCH_ID: str, BASE_URL: str):
+    thread = threading.Thread(
+        target=sync_until_ready,
+        args=(SYNC_SERVICE_URLS, BRANCH_ID, BASE_URL),
+        name="startup-sync",
+        daemon=True,
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,137 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from acker import ack_events
+from cache import product_cache
+from config import STARTUP_MAX_BACKOFF_SECONDS
+from database import connect
+from event_handler import apply_events, catch_up
+from http_client import HTTP_CONNECT_TIMEOUT_SECONDS
+from models import NotifyIn
+from partition import SYNC_PARTITIONS
+from websockets.sync.client import connect as open_stream
+
+
+@dataclass
+class StreamState:
+    connected: bool = False
+    connects: int = 0
+    frames: int = 0
+    events: int = 0
+    last_error: Optional[str] = None
+
+    def to_dict(self):
+        return {
+            "connected": self.connected,
+            "connects": self.connects,
+            "frames": self.frames,
+            "events": self.events,
+            "last_error": self.last_error,
+        }
+
+
+# One stream per sync service partition
+stream_states = [StreamState() for _ in range(SYNC_PARTITIONS)]
+
+
+def stream_url(SYNC_SERVICE_BASE_URL: str, BRANCH_ID: str):
+    # http -> ws, https -> wss
+    return f"ws{SYNC_SERVICE_BASE_URL[len('http'):]}/event/stream/{BRANCH_ID}"
+
+
+# Apply one frame of events in one transaction. Returns the ids
+# to ack; UPDATEs of unknown products stay non-consumed
+def apply_frame(conn, events: list, BRANCH_ID: str):
+    applied, _ = apply_events(conn.cursor(), events, BRANCH_ID)
+    conn.commit()
+    product_cache.invalidate({event.sub for event in events})
+    return applied
+
+
+def stream_forever(
+    SYNC_SERVICE_BASE_URL: str, BRANCH_ID: str, startup_state, partition: int
+):
+    conn = connect()
+    stream_state = stream_states[partition]
+    backoff = 1.0
+
+    while True:
+        try:
+            with open_stream(
+                stream_url(SYNC_SERVICE_BASE_URL, BRANCH_ID),
+                open_timeout=HTTP_CONNECT_TIMEOUT_SECONDS,
+            ) as websocket:
+                stream_state.connected = True
+                stream_state.connects += 1
+                backoff = 1.0
+                print(f"Stream connected to sync service partition {partition}")
+                startup_state.save(conn)
+
+                # Events published before the stream opened were
+                # delivered to nobody. The startup catch-up reads
+                # them when it has not started yet; otherwise they
+                # are caught up here.
+                if startup_state.catch_up_started:
+                    catch_up(
+                        db=conn,
+                        SYNC_SERVICE_BASE_URL=SYNC_SERVICE_BASE_URL,
+                        BRANCH_ID=BRANCH_ID,
+                        ack=ack_events,
+                    )
+
+                for message in websocket:
+                    events = [
+                        NotifyIn(**event) for event in json.loads(message)["events"]
+                    ]
+                    applied = apply_frame(conn, events, BRANCH_ID)
+                    stream_state.frames += 1
+                    stream_state.events += len(events)
+                    if applied:
+                        websocket.send(json.dumps({"ack": applied}))
+        except Exception as e:
+            conn.rollback()
+            stream_state.last_error = str(e)
+            print(f"Stream failed, reconnecting in {backoff}s: {str(e)}")
+
+        stream_state.connected = False
+        startup_state.save(conn)
+        time.sleep(backoff)
+        backoff = min(backoff * 2, STARTUP_MAX_BACKOFF_SECONDS)
+
+
+# ===================================================
+# Push channel from the sync service (SYNC_DELIVERY=stream):
+# 1. One long-lived WebSocket to /event/stream/{BRANCH_ID}, opened
+# by the branch, so the branch needs no inbound URL
+# 2. Each frame carries many events; they are applied in one
+# transaction and acked inline on the same connection
+# 3. On every reconnect the events published while the stream
+# was down are caught up from the sync service
+# 4. Reconnects with exponential backoff
+# With a partitioned sync service, one stream is opened to every
+# partition. Progress is reported by GET /ready ("stream").
+# ===================================================
+def start_stream(SYNC_SERVICE_URLS: list, BRANCH_ID: str, startup_state):
+    threads = []
+    for partition, SYNC_SERVICE_BASE_URL in enumerate(SYNC_SERVICE_URLS):
+        thread = threading.Thread(
+            target=stream_forever,
+            args=(SYNC_SERVICE_BASE_URL, BRANCH_ID, startup_state, partition),
+            name=f"event-stream-{partition}",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -0,0 +1,131 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+# Regression check for delta coalescing across catch-ups.
+#
+# Creates both databases from scratch and replays, with the real
+# event_store and apply_events (no HTTP):
+#   1. branch b applies UPDATE 2 through /notify; its ack is lost
+#   2. a catch-up merges UPDATEs 2 and 3 into 4, not delivered
+#   3. UPDATE 5 is published; the next catch-up merges 4 and 5
+#   4. b catches up and applies the merged event
+# The balance must reflect every UPDATE exactly once. Fails
+# (exit 1) otherwise.
+#
+# Usage: python bench/coalescing_check.py
+# ===================================================
+import importlib
+import json
+import os
+import sys
+import tempfile
+
+from query_plans import use_service
+
+INITIAL_BALANCE = 10
+DELTAS = [-1, -2, -4]
+
+
+def event(operation: str, delta: int = 0):
+    return {
+        "operation": operation,
+        "sub": 1,
+        "initial_balance": INITIAL_BALANCE if operation == "CREATE" else 0,
+        "current_balance": 0,
+        "delta": delta,
+    }
+
+
+def notify_in(models, row):
+    return models.NotifyIn(
+        event_consumer_id=row["id"],
+        publisher_branch_id=row["publisher_id"],
+        operation=row["operation"],
+        sub=row["sub"],
+        initial_balance=row["initial_balance"],
+        current_balance=row["current_balance"],
+        delta=row["delta"],
+        coalesced=json.loads(row["coalesced"]) if row["coalesced"] else None,
+    )
+
+
+def check():
+    use_service("sync-service")
+    sync_database = importlib.import_module("database")
+    sync_database.start_database()
+    event_store = importlib.import_module("event_store")
+
+    use_service("api")
+    api_database = importlib.import_module("database")
+    api_database.start_database()
+    event_handler = importlib.import_module("event_handler")
+    models = importlib.import_module("models")
+
+    sync = sync_database.connect()
+    branch = api_database.connect()
+    for subscriber_id in ("a", "b"):
+        sync.execute(
+            "INSERT INTO subscriber (id, branch_url, committed_seq) VALUES (?, ?, 0)",
+            (subscriber_id, f"stream://{subscriber_id}"),
+        )
+    sync.commit()
+
+    def deliver(rows):
+        applied, _ = event_handler.apply_events(
+            branch.cursor(), [notify_in(models, row) for row in rows], "b"
+        )
+        branch.commit()
+        return applied
+
+    def pending():
+        return event_store.pending_events(sync, "b", 0, 500)
+
+    # The CREATE is delivered and acked
+    event_store.fan_out_events(sync, "a", [event("CREATE")])
+    event_store.consume_events(sync, "b", deliver(pending()))
+
+    event_store.fan_out_events(sync, "a", [event("UPDATE", DELTAS[0])])
+    deliver(pending())
+    event_store.fan_out_events(sync, "a", [event("UPDATE", DELTAS[1])])
+    event_store.coalesce_pending_updates(sync, "b")
+    event_store.fan_out_events(sync, "a", [event("UPDATE", DELTAS[2])])
+    event_store.coalesce_pending_updates(sync, "b")
+
+    rows = pending()
+    merged = [row["coalesced"] for row in rows]
+    event_store.consume_events(sync, "b", deliver(rows))
+
+    balance = branch.execute(
+        "SELECT current_balance FROM product WHERE id = 1"
+    ).fetchone()[0]
+    sync.close()
+    branch.close()
+    return balance, merged
+
+
+def main():
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            # Merge the events published just now
+            os.environ["COALESCE_MIN_AGE_SECONDS"] = "0"
+            balance, merged = check()
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+
+    expected = INITIAL_BALANCE + sum(DELTAS)
+    print(f"Delivered after two merge passes: {merged}")
+    print(f"Balance {balance}, expected {expected}")
+    sys.exit(0 if balance == expected else 1)
+
+
+if __name__ == "__main__":
+    main()
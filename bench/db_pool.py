@@ -0,0 +1,146 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+# Request throughput of the branch database under concurrency.
+#
+# Runs the same request-like unit of work (read a product,
+# take stock, write the order rows and the outbox event,
+# commit) from several threads, the way the uvicorn
+# threadpool does, with:
+#   before - a new default connection per request
+#            (rollback journal, synchronous=FULL)
+#   after  - get_db: pooled, tuned connections (WAL,
+#            busy_timeout, synchronous=NORMAL)
+#
+# Usage: python bench/db_pool.py [--threads 16] [--requests 200]
+# ===================================================
+import argparse
+import importlib.util
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PRODUCTS = 50
+
+
+def load_module(name: str):
+    spec = importlib.util.spec_from_file_location(
+        f"api_{name}", os.path.join(ROOT, "api", f"{name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# api/database.py times its commits with the API's metrics.py
+def load_database_module():
+    sys.modules["metrics"] = load_module("metrics")
+    return load_module("database")
+
+
+def per_request_connection():
+    conn = sqlite3.connect("product_database.db", check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def place_order(db, product_id):
+    cursor = db.cursor()
+    cursor.execute("SELECT * FROM product WHERE id = ?", (product_id,)).fetchone()
+    cursor.execute(
+        "UPDATE product SET current_balance = current_balance - ? WHERE id = ? AND current_balance >= ?",
+        (1, product_id, 1),
+    )
+    request_id = cursor.execute(
+        "INSERT INTO request (created_at) VALUES (datetime('now'))"
+    ).lastrowid
+    cursor.execute(
+        "INSERT INTO product_request (product_id, request_id, quantity, status) VALUES (?, ?, ?, ?)",
+        (product_id, request_id, 1, "CONFIRMED"),
+    )
+    cursor.execute(
+        "INSERT INTO outbox (operation, sub, initial_balance, current_balance, delta) VALUES (?, ?, ?, ?, ?)",
+        ("UPDATE", product_id, 0, 0, -1),
+    )
+    db.commit()
+
+
+def run(get_db, threads, requests):
+    errors = []
+
+    def worker(offset):
+        for i in range(requests):
+            dependency = get_db()
+            db = next(dependency)
+            try:
+                place_order(db, (offset + i) % PRODUCTS + 1)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+            finally:
+                dependency.close()
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return threads * requests / elapsed, len(errors)
+
+
+def measure(mode, threads, requests):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        database = load_database_module()
+        database.start_database()
+
+        conn = sqlite3.connect("product_database.db")
+        if mode == "before":
+            conn.execute("PRAGMA journal_mode = DELETE")
+        conn.executemany(
+            "INSERT INTO product (id, current_balance) VALUES (?, ?)",
+            [(i, 1_000_000) for i in range(1, PRODUCTS + 1)],
+        )
+        conn.commit()
+        conn.close()
+
+        get_db = per_request_connection if mode == "before" else database.get_db
+        return run(get_db, threads, requests)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    print(f"{'mode':>8} {'req/s':>10} {'locked errors':>14}")
+    try:
+        results = {}
+        for mode in ["before", "after"]:
+            throughput, errors = measure(mode, args.threads, args.requests)
+            results[mode] = throughput
+            print(f"{mode:>8} {throughput:>10.1f} {errors:>14}")
+        print(f"speedup: {results['after'] / results['before']:.1f}x")
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
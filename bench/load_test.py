@@ -0,0 +1,460 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+# End-to-end load test of the whole network.
+#
+# Starts the sync service (--partitions processes) and --branches
+# branch APIs on free ports, each with a database of its own in a
+# temporary directory, creates the products on the first branch
+# and waits until every branch has them. Then, for --duration
+# seconds, --concurrency clients per branch send a mix of:
+#   order  - POST /place-order with --order-items products
+#   update - PATCH /product/{id} (a new absolute balance)
+#   get    - GET /product/{id}
+# --hot-share of the products picked come from the first
+# --hot-products ids, so the lock contention can be tuned.
+# Meanwhile a probe writes a dedicated product on one branch and
+# times how long the other branches take to see the new value
+# (replication lag).
+#
+# Reports throughput and p50/p95/p99 latency per operation, the
+# lock conflict rate (order items cancelled by a lock, updates
+# refused with 409) and the replication lag, and writes them as
+# JSON to --output, so runs can be compared.
+#
+# Usage: python bench/load_test.py [--branches 2] [--duration 30]
+#        [--mix order=60,update=10,get=30] [--output load_test.json]
+# ===================================================
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BRANCH_IDS = [f"{branch:032x}" for branch in range(1, 1000)]
+# Large enough that no order fails for lack of stock: every
+# unconfirmed item was cancelled by a lock
+INITIAL_BALANCE = 1_000_000_000
+STARTUP_TIMEOUT_SECONDS = 60
+LAG_POLL_SECONDS = 0.005
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(script: str, cwd: str, env: dict):
+    os.makedirs(cwd, exist_ok=True)
+    log = open(os.path.join(cwd, "service.log"), "w")
+    return subprocess.Popen(
+        [sys.executable, script],
+        cwd=cwd,
+        env={**os.environ, **env},
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def stop_processes(processes: list):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def start_network(tmp: str, args):
+    processes = []
+    sync_urls = []
+    for partition in range(args.partitions):
+        port = free_port()
+        sync_urls.append(f"http://127.0.0.1:{port}")
+        processes.append(
+            start_process(
+                os.path.join(ROOT, "sync-service", "sync_service.py"),
+                os.path.join(tmp, f"sync-{partition}"),
+                {
+                    "PORT": str(port),
+                    "SYNC_PARTITIONS": str(args.partitions),
+                    "SYNC_PARTITION": str(partition),
+                },
+            )
+        )
+
+    branch_urls = []
+    for branch in range(args.branches):
+        port = free_port()
+        branch_urls.append(f"http://127.0.0.1:{port}")
+        processes.append(
+            start_process(
+                os.path.join(ROOT, "api", "app.py"),
+                os.path.join(tmp, f"branch-{branch}"),
+                {
+                    "PORT": str(port),
+                    "BRANCH_ID": BRANCH_IDS[branch],
+                    "BASE_URL": branch_urls[-1],
+                    "SYNC_SERVICE_BASE_URL": sync_urls[0],
+                    "SYNC_SERVICE_URLS": ",".join(sync_urls),
+                    "SYNC_DELIVERY": args.delivery,
+                    "WORKERS": str(args.workers),
+                },
+            )
+        )
+    return processes, sync_urls, branch_urls
+
+
+def print_logs(tmp: str):
+    for name in sorted(os.listdir(tmp)):
+        with open(os.path.join(tmp, name, "service.log")) as log:
+            lines = log.readlines()[-20:]
+        print(f"--- {name} ---\n{''.join(lines)}")
+
+
+async def wait_ready(client: httpx.AsyncClient, branch_urls: list, processes: list):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    pending = list(branch_urls)
+    while pending:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Branches not ready: {pending}")
+        if any(process.poll() is not None for process in processes):
+            raise RuntimeError("A service exited during startup")
+        try:
+            if (await client.get(f"{pending[0]}/ready")).status_code == 200:
+                pending.pop(0)
+                continue
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+
+
+async def login(client: httpx.AsyncClient, branch_url: str):
+    response = await client.post(
+        f"{branch_url}/login", json={"username": "admin", "password": "admin123"}
+    )
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def balance(client: httpx.AsyncClient, branch_url: str, headers, product_id):
+    response = await client.get(f"{branch_url}/product/{product_id}", headers=headers)
+    if response.status_code != 200:
+        return None
+    return response.json()["current_balance"]
+
+
+# Create products 1..count on the first branch and wait until
+# every branch has all of them
+async def create_products(client, branch_urls: list, headers: list, count: int):
+    for product_id in range(1, count + 1):
+        response = await client.post(
+            f"{branch_urls[0]}/product",
+            json={"id": product_id, "initial_balance": INITIAL_BALANCE},
+            headers=headers[0],
+        )
+        response.raise_for_status()
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    for branch_url, branch_headers in zip(branch_urls[1:], headers[1:]):
+        while await balance(client, branch_url, branch_headers, count) is None:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Products not replicated to {branch_url}")
+            await asyncio.sleep(0.1)
+        for product_id in range(1, count + 1):
+            while await balance(client, branch_url, branch_headers, product_id) is None:
+                await asyncio.sleep(0.1)
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        operation, weight = part.split("=")
+        if operation not in ("order", "update", "get"):
+            raise ValueError(f"Unknown operation in --mix: {operation}")
+        weights[operation] = float(weight)
+    return weights
+
+
+class Load:
+    def __init__(self, args):
+        self.args = args
+        self.weights = parse_mix(args.mix)
+        self.latencies = {operation: [] for operation in self.weights}
+        self.errors = {operation: 0 for operation in self.weights}
+        self.order_items = 0
+        self.confirmed_items = 0
+        self.update_conflicts = 0
+
+    def pick_product(self):
+        if random.random() < self.args.hot_share:
+            return random.randint(1, self.args.hot_products)
+        return random.randint(1, self.args.products)
+
+    def pick_order(self):
+        product_ids = set()
+        while len(product_ids) < self.args.order_items:
+            product_ids.add(self.pick_product())
+        return [{"product_id": product_id, "quantity": 1} for product_id in product_ids]
+
+    async def order(self, client, branch_url, headers):
+        items = self.pick_order()
+        response = await client.post(
+            f"{branch_url}/place-order", json={"items": items}, headers=headers
+        )
+        if response.status_code == 200:
+            self.order_items += len(items)
+            self.confirmed_items += response.json()["confirmed_items"]
+        return response.status_code == 200
+
+    async def update(self, client, branch_url, headers):
+        response = await client.patch(
+            f"{branch_url}/product/{self.pick_product()}",
+            json={"current_balance": INITIAL_BALANCE + random.randint(0, 1000)},
+            headers=headers,
+        )
+        if response.status_code == 409:
+            self.update_conflicts += 1
+        return response.status_code in (200, 409)
+
+    async def get(self, client, branch_url, headers):
+        response = await client.get(
+            f"{branch_url}/product/{self.pick_product()}", headers=headers
+        )
+        return response.status_code == 200
+
+    async def client_forever(self, client, branch_url, headers, deadline):
+        operations = list(self.weights)
+        weights = [self.weights[operation] for operation in operations]
+        while time.monotonic() < deadline:
+            operation = random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = await getattr(self, operation)(client, branch_url, headers)
+            except httpx.HTTPError:
+                ok = False
+            self.latencies[operation].append(time.perf_counter() - start)
+            if not ok:
+                self.errors[operation] += 1
+
+
+# ===================================================
+# Replication lag probe: every --lag-interval seconds, one branch
+# (in turn) writes a new balance to its probe product, outside the
+# products of the load, and the time until every other branch
+# serves that balance is recorded. Probes not seen within
+# --lag-timeout count as timeouts.
+# ===================================================
+async def probe_lag(client, branch_urls, headers, args, deadline):
+    lags, timeouts = [], 0
+    probe = 0
+    while time.monotonic() < deadline and len(branch_urls) > 1:
+        source = probe % len(branch_urls)
+        product_id = args.products + 1 + source
+        value = INITIAL_BALANCE + probe
+        response = await client.patch(
+            f"{branch_urls[source]}/product/{product_id}",
+            json={"current_balance": value},
+            headers=headers[source],
+        )
+        written = time.perf_counter()
+        probe += 1
+        if response.status_code != 200:
+            continue
+
+        for target, branch_url in enumerate(branch_urls):
+            if target == source:
+                continue
+            while True:
+                seen = await balance(client, branch_url, headers[target], product_id)
+                if seen == value:
+                    lags.append(time.perf_counter() - written)
+                    break
+                if time.perf_counter() - written > args.lag_timeout:
+                    timeouts += 1
+                    break
+                await asyncio.sleep(LAG_POLL_SECONDS)
+        await asyncio.sleep(args.lag_interval)
+    return lags, timeouts
+
+
+def percentile(sorted_values: list, fraction: float):
+    if not sorted_values:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def latency_stats(values: list, elapsed: float):
+    values = sorted(values)
+    return {
+        "requests": len(values),
+        "throughput": len(values) / elapsed,
+        "p50_ms": (percentile(values, 0.50) or 0) * 1000,
+        "p95_ms": (percentile(values, 0.95) or 0) * 1000,
+        "p99_ms": (percentile(values, 0.99) or 0) * 1000,
+        "max_ms": (values[-1] if values else 0) * 1000,
+    }
+
+
+def report(load: Load, lags: list, timeouts: int, elapsed: float, args, started_at):
+    operations = {
+        operation: {
+            **latency_stats(load.latencies[operation], elapsed),
+            "errors": load.errors[operation],
+        }
+        for operation in load.weights
+    }
+    total = sum(len(values) for values in load.latencies.values())
+    cancelled = load.order_items - load.confirmed_items
+    updates = len(load.latencies.get("update", []))
+    lags = sorted(lags)
+
+    return {
+        "started_at": started_at,
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "elapsed_seconds": elapsed,
+        "throughput": total / elapsed,
+        "operations": operations,
+        "lock_conflicts": {
+            "order_items": load.order_items,
+            "order_items_cancelled": cancelled,
+            "order_item_conflict_rate": cancelled / max(load.order_items, 1),
+            "update_conflicts": load.update_conflicts,
+            "update_conflict_rate": load.update_conflicts / max(updates, 1),
+        },
+        "replication_lag": {
+            "samples": len(lags),
+            "timeouts": timeouts,
+            "p50_ms": (percentile(lags, 0.50) or 0) * 1000,
+            "p95_ms": (percentile(lags, 0.95) or 0) * 1000,
+            "p99_ms": (percentile(lags, 0.99) or 0) * 1000,
+            "max_ms": (lags[-1] if lags else 0) * 1000,
+        },
+    }
+
+
+def print_report(results: dict):
+    print(
+        f"{'operation':>9} {'requests':>9} {'req/s':>8} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+    )
+    for operation, stats in results["operations"].items():
+        print(
+            f"{operation:>9} {stats['requests']:>9} {stats['throughput']:>8.1f} "
+            f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+            f"{stats['p99_ms']:>8.1f} {stats['errors']:>7}"
+        )
+    print(f"total throughput: {results['throughput']:.1f} req/s")
+
+    conflicts = results["lock_conflicts"]
+    print(
+        f"lock conflicts: {conflicts['order_item_conflict_rate']:.1%} of order items, "
+        f"{conflicts['update_conflict_rate']:.1%} of updates"
+    )
+    lag = results["replication_lag"]
+    print(
+        f"replication lag: p50 {lag['p50_ms']:.1f} ms, p95 {lag['p95_ms']:.1f} ms, "
+        f"p99 {lag['p99_ms']:.1f} ms ({lag['samples']} samples, "
+        f"{lag['timeouts']} timeouts)"
+    )
+
+
+async def run(args, branch_urls: list, processes: list):
+    limits = httpx.Limits(
+        max_connections=args.branches * args.concurrency + args.branches
+    )
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        await wait_ready(client, branch_urls, processes)
+        headers = [await login(client, branch_url) for branch_url in branch_urls]
+        # One probe product per branch after the products of the load
+        await create_products(
+            client, branch_urls, headers, args.products + args.branches
+        )
+
+        load = Load(args)
+        started_at = datetime.now(timezone.utc).isoformat()
+        start = time.perf_counter()
+        deadline = time.monotonic() + args.duration
+        clients = [
+            load.client_forever(client, branch_url, branch_headers, deadline)
+            for branch_url, branch_headers in zip(branch_urls, headers)
+            for _ in range(args.concurrency)
+        ]
+        (lags, timeouts), *_ = await asyncio.gather(
+            probe_lag(client, branch_urls, headers, args, deadline), *clients
+        )
+        elapsed = time.perf_counter() - start
+
+    return report(load, lags, timeouts, elapsed, args, started_at)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--branches", type=int, default=2)
+    parser.add_argument("--partitions", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--delivery", choices=["stream", "notify"], default="stream")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", default="order=60,update=10,get=30")
+    parser.add_argument("--products", type=int, default=100)
+    parser.add_argument("--hot-products", type=int, default=5)
+    parser.add_argument("--hot-share", type=float, default=0.5)
+    parser.add_argument("--order-items", type=int, default=2)
+    parser.add_argument("--lag-interval", type=float, default=0.5)
+    parser.add_argument("--lag-timeout", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default="load_test.json")
+    parser.add_argument("--keep", action="store_true", help="keep databases and logs")
+    args = parser.parse_args()
+    if args.order_items > args.products:
+        parser.error("--order-items can not exceed --products")
+    random.seed(args.seed)
+
+    tmp = tempfile.mkdtemp(prefix="load_test_")
+    processes, _, branch_urls = start_network(tmp, args)
+    try:
+        results = asyncio.run(run(args, branch_urls, processes))
+    except Exception:
+        print_logs(tmp)
+        raise
+    finally:
+        stop_processes(processes)
+        if args.keep:
+            print(f"Databases and logs kept in {tmp}")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print_report(results)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
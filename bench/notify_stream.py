@@ -0,0 +1,119 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+# Delivery cost per event: /notify callbacks vs the stream.
+#
+# Starts a local branch stub (uvicorn) that parses every event
+# into NotifyIn, and delivers the same events with:
+#   notify - one POST /notify per event (keep-alive connection)
+#   stream - frames of --frame events on one WebSocket, each
+#            frame acked inline, like /event/stream
+# Nothing is written to a database: only the transport and the
+# parsing are measured.
+#
+# Usage: python bench/notify_stream.py [--events 2000] [--frame 100]
+# ===================================================
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from typing import List
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, WebSocket
+from starlette.websockets import WebSocketDisconnect
+from websockets.sync.client import connect as open_stream
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+from models import NotifyIn  # noqa: E402
+
+PORT = 4990
+
+branch = FastAPI()
+
+
+@branch.post("/notify")
+def notify(notify_data: List[NotifyIn]):
+    return None
+
+
+@branch.websocket("/event/stream")
+async def stream(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        while True:
+            message = await websocket.receive_text()
+            events = [NotifyIn(**event) for event in json.loads(message)["events"]]
+            await websocket.send_json(
+                {"ack": [event.event_consumer_id for event in events]}
+            )
+    except WebSocketDisconnect:
+        pass
+
+
+def event(event_id: int):
+    return {
+        "event_consumer_id": event_id,
+        "publisher_branch_id": "a",
+        "operation": "UPDATE",
+        "sub": event_id % 100,
+        "initial_balance": 100,
+        "current_balance": 99,
+        "delta": -1,
+    }
+
+
+def per_event_notify(events: int, frame: int):
+    with httpx.Client() as client:
+        for event_id in range(1, events + 1):
+            client.post(
+                f"http://localhost:{PORT}/notify", json=[event(event_id)]
+            ).raise_for_status()
+
+
+def streamed(events: int, frame: int):
+    with open_stream(f"ws://localhost:{PORT}/event/stream") as websocket:
+        for start in range(1, events + 1, frame):
+            batch = [event(event_id) for event_id in range(start, start + frame)]
+            websocket.send(json.dumps({"events": batch[: events - start + 1]}))
+            json.loads(websocket.recv())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--frame", type=int, default=100)
+    args = parser.parse_args()
+
+    server = uvicorn.Server(uvicorn.Config(branch, port=PORT, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    print(f"{'mode':>7} {'events':>7} {'seconds':>8} {'events/s':>9} {'us/event':>9}")
+    for mode, deliver in [("notify", per_event_notify), ("stream", streamed)]:
+        start = time.perf_counter()
+        deliver(args.events, args.frame)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{mode:>7} {args.events:>7} {elapsed:>8.2f} "
+            f"{args.events / elapsed:>9.0f} {elapsed / args.events * 1e6:>9.0f}"
+        )
+
+    server.should_exit = True
+    thread.join()
+
+
+if __name__ == "__main__":
+    main()
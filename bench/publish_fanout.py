@@ -0,0 +1,113 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+# Publish cost as the number of subscribers grows.
+#
+# Compares the old layout (one event row copied per subscriber
+# with INSERT ... SELECT, one commit) with the event log used by
+# /event/publish (one row per event, read by every subscriber
+# through its offset, one commit). Reports the time per publish
+# and the event rows written per publish.
+#
+# Usage: python bench/publish_fanout.py [--publishes 200]
+# ===================================================
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "sync-service"))
+
+from database import start_database  # noqa: E402
+from event_store import fan_out_events  # noqa: E402
+
+SUBSCRIBER_COUNTS = [1, 5, 10, 30, 100]
+
+
+def per_subscriber_publish(db, publisher_id):
+    db.execute(
+        """
+        INSERT INTO event (publisher_id, subscriber_id, operation, sub, initial_balance, current_balance, delta)
+        SELECT ?, id, ?, ?, ?, ?, ? FROM subscriber WHERE id != ?
+        """,
+        (publisher_id, "UPDATE", 1, 0, 0, -1, publisher_id),
+    )
+    db.commit()
+
+
+def log_publish(db, publisher_id):
+    fan_out_events(
+        db=db,
+        publisher_id=publisher_id,
+        events=[
+            {
+                "operation": "UPDATE",
+                "sub": 1,
+                "initial_balance": 0,
+                "current_balance": 0,
+                "delta": -1,
+            }
+        ],
+    )
+
+
+def measure(publish, subscribers, publishes):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        start_database()
+        db = sqlite3.connect("sync_database.db")
+        db.executemany(
+            "INSERT INTO subscriber (id, branch_url) VALUES (?, ?)",
+            [
+                (f"branch-{i}", f"http://localhost:{5000 + i}")
+                for i in range(subscribers)
+            ],
+        )
+        db.commit()
+
+        start = time.perf_counter()
+        for _ in range(publishes):
+            publish(db, "branch-0")
+        elapsed = time.perf_counter() - start
+        rows = db.execute(
+            "SELECT (SELECT COUNT(*) FROM event) + (SELECT COUNT(*) FROM event_log)"
+        ).fetchone()[0]
+
+        db.close()
+        return elapsed / publishes * 1000, rows / publishes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--publishes", type=int, default=200)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    print(
+        f"{'subscribers':>12} {'copies ms':>10} {'copies rows':>12} "
+        f"{'log ms':>8} {'log rows':>9}"
+    )
+    try:
+        for subscribers in SUBSCRIBER_COUNTS:
+            copies, copy_rows = measure(
+                per_subscriber_publish, subscribers, args.publishes
+            )
+            log, log_rows = measure(log_publish, subscribers, args.publishes)
+            print(
+                f"{subscribers:>12} {copies:>10.3f} {copy_rows:>12.0f} "
+                f"{log:>8.3f} {log_rows:>9.0f}"
+            )
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+# Query-plan regression check for the hot query paths.
+#
+# Creates both databases from scratch with start_database, then
+# calls the real hot-path functions of each service (event_store,
+# retention, snapshot, lock_manager; app, event_handler, outbox,
+# acker...) on connections that record every statement they run.
+# Runs EXPLAIN QUERY PLAN on each recorded SELECT, INSERT, UPDATE
+# and DELETE. Fails (exit 1) when any of them does a full table
+# scan, so the check follows the queries as the code changes.
+#
+# Usage: python bench/query_plans.py
+# ===================================================
+import importlib
+import os
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SERVICES = ["sync-service", "api"]
+
+# The recorded statements that are checked
+CHECKED = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+# A handful of rows by design (one per AUTOINCREMENT table, one
+# per branch): scanning them costs as much as a lookup
+SMALL_TABLES = {"sqlite_sequence", "subscriber"}
+
+# sync_service.py starts uvicorn when imported, so the SQL its
+# handlers run inline is copied here (subscribe, fan_out_stored,
+# consume_event, subscriber_exists). Keep it in sync.
+SYNC_SERVICE_HANDLER_QUERIES = [
+    ("SELECT id FROM subscriber WHERE id = ? OR branch_url = ?", ("a", "stream://a")),
+    (
+        """
+        INSERT INTO subscriber (id, branch_url, committed_seq) VALUES (?, ?, COALESCE(
+            (SELECT seq FROM sqlite_sequence WHERE name = 'event_log'), 0
+        ))
+        """,
+        ("a", "stream://a"),
+    ),
+    (
+        """
+        INSERT INTO subscriber (id, branch_url, committed_seq) VALUES (?, ?, COALESCE(
+            (SELECT seq FROM sqlite_sequence WHERE name = 'event_log'), 0
+        ))
+        """,
+        ("b", "stream://b"),
+    ),
+    ("SELECT id FROM subscriber WHERE id = ?", ("a",)),
+    ("SELECT seq, target_id FROM event_log WHERE seq = ?", (1,)),
+    ("SELECT 1 FROM subscriber WHERE id = ?", ("b",)),
+]
+
+
+# Import a service's modules by their plain names, as the service
+# does: both services have a database.py, models.py, partition.py...
+# so the other service's modules are forgotten first
+def use_service(service: str):
+    for other in SERVICES:
+        path = os.path.join(ROOT, other)
+        for name in os.listdir(path):
+            if name.endswith(".py"):
+                sys.modules.pop(name[:-3], None)
+        if path in sys.path:
+            sys.path.remove(path)
+    sys.path.insert(0, os.path.join(ROOT, service))
+    importlib.invalidate_caches()
+
+
+# Every connection opened by the service's database.connect (the
+# pool's, the background workers' and the callers') records the
+# statements it runs. Must run before the modules that import
+# connect by name.
+def record_statements(database, statements: list):
+    connect = database.connect
+
+    def recording_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    database.connect = recording_connect
+
+
+class Recorder:
+    def __init__(self):
+        self.statements = []
+        # (function, statement, tables the function reads whole)
+        self.checked = []
+
+    def run(self, function: str, call, scans: set = frozenset()):
+        self.statements.clear()
+        call()
+        for statement in self.statements:
+            if statement.lstrip().upper().startswith(CHECKED):
+                self.checked.append((function, statement, scans))
+        self.statements.clear()
+
+
+def full_scans(conn, checked: list):
+    failures, seen = [], set()
+    for function, sql, scans in checked:
+        sql = " ".join(sql.split())
+        if sql in seen:
+            continue
+        seen.add(sql)
+
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        details = [row[3] for row in plan]
+        # "SCAN table" (with or without an index) visits every row
+        scanned = [
+            detail.split()[1] for detail in details if detail.startswith("SCAN ")
+        ]
+        if any(table not in SMALL_TABLES | scans for table in scanned):
+            failures.append((function, sql, details))
+    return failures
+
+
+def sync_service_plans(recorder: Recorder):
+    use_service("sync-service")
+    database = importlib.import_module("database")
+    record_statements(database, recorder.statements)
+    database.start_database()
+
+    event_store = importlib.import_module("event_store")
+    lock_manager = importlib.import_module("lock_manager")
+    retention = importlib.import_module("retention")
+    snapshot = importlib.import_module("snapshot")
+
+    conn = database.connect()
+
+    def handlers():
+        for sql, params in SYNC_SERVICE_HANDLER_QUERIES:
+            conn.execute(sql, params)
+        conn.commit()
+
+    recorder.run("sync_service.py handlers", handlers)
+
+    events = [
+        {
+            "operation": "CREATE",
+            "sub": 1,
+            "initial_balance": 10,
+            "current_balance": 0,
+            "delta": 0,
+            "event_key": "create-1",
+        }
+    ] + [
+        {
+            "operation": "UPDATE",
+            "sub": 1,
+            "initial_balance": 0,
+            "current_balance": 0,
+            "delta": -1,
+            "event_key": f"update-{n}",
+        }
+        for n in range(3)
+    ]
+    recorder.run(
+        "fan_out_events", lambda: event_store.fan_out_events(conn, "a", events)
+    )
+    # A retried batch: every event_key is already in the log
+    recorder.run(
+        "fan_out_events", lambda: event_store.fan_out_events(conn, "a", events)
+    )
+    recorder.run(
+        "coalesce_pending_updates",
+        lambda: event_store.coalesce_pending_updates(conn, "b"),
+    )
+    pending = []
+    recorder.run(
+        "pending_events",
+        lambda: pending.extend(event_store.pending_events(conn, "b", 0, 500)),
+    )
+    recorder.run(
+        "consume_events",
+        lambda: event_store.consume_events(
+            conn, "b", [event["id"] for event in pending[:1]]
+        ),
+    )
+    recorder.run(
+        "snapshot_lines",
+        lambda: list(snapshot.snapshot_lines("b", database.DATABASE)),
+        scans={"product_balance"},
+    )
+    recorder.run(
+        "consume_events_through",
+        lambda: event_store.consume_events_through(
+            conn, "b", event_store.head_seq(conn)
+        ),
+    )
+
+    audit = lock_manager.LockAuditTrail(database.DATABASE)
+    lease = lock_manager.Lease(1, "a", 1, lock_manager.now_timestamp(), 0.0)
+    timestamp = lock_manager.now_timestamp()
+    recorder.run(
+        "LockAuditTrail.write",
+        lambda: audit.write(
+            conn, [("ACQUIRE", lease, timestamp), ("RELEASE", lease, timestamp)]
+        ),
+    )
+
+    recorder.run(
+        "event_table_stats",
+        lambda: retention.event_table_stats(conn),
+        scans={"event_log", "event"},
+    )
+    event_retention = retention.EventRetention(database.DATABASE, "archive")
+    archive = event_retention.open()
+    recorder.run("EventRetention.run_once", lambda: event_retention.run_once(archive))
+
+    # The archive database is attached, for the archiving INSERTs
+    archive.set_trace_callback(None)
+    failures = full_scans(archive, recorder.checked)
+    archive.close()
+    conn.close()
+    return failures
+
+
+def api_plans(recorder: Recorder):
+    use_service("api")
+    database = importlib.import_module("database")
+    record_statements(database, recorder.statements)
+    database.start_database()
+
+    app = importlib.import_module("app")
+    acker = importlib.import_module("acker")
+    models = importlib.import_module("models")
+    outbox = importlib.import_module("outbox")
+    snapshot = importlib.import_module("snapshot")
+    startup = importlib.import_module("startup")
+
+    conn = database.connect()
+    for id in (1, 2):
+        recorder.run(
+            "create_product",
+            lambda: app.create_product(
+                models.ProductIn(id=id, initial_balance=100), conn, "bench"
+            ),
+        )
+    recorder.run(
+        "select_product_by_id", lambda: app.select_product_by_id(1, conn, "bench")
+    )
+    recorder.run("missing_products", lambda: app.missing_products(conn, [1, 2, 3]))
+    recorder.run("write_product_update", lambda: app.write_product_update(conn, 1, 50))
+
+    items = [
+        models.OrderItem(product_id=1, quantity=1),
+        models.OrderItem(product_id=2, quantity=1000),
+    ]
+    order = []
+    recorder.run(
+        "process_order",
+        lambda: order.extend(app.process_order(conn, items, {1: 1, 2: 2})),
+    )
+    recorder.run(
+        "get_order_details", lambda: app.get_order_details(order[0], conn, "bench")
+    )
+
+    event = {
+        "publisher_branch_id": "other",
+        "operation": "UPDATE",
+        "sub": 1,
+        "initial_balance": 0,
+        "current_balance": 0,
+        "delta": -2,
+    }
+    recorder.run(
+        "notify",
+        lambda: app.notify(
+            [
+                models.NotifyIn(event_consumer_id=10, **event),
+                models.NotifyIn(
+                    event_consumer_id=13, coalesced=[[11, -1], [12, -1]], **event
+                ),
+            ],
+            conn,
+        ),
+    )
+
+    # Nothing listens on the discard port: the publish fails
+    recorder.run(
+        "drain_outbox",
+        lambda: outbox.drain_outbox(conn, "http://127.0.0.1:9", "bench"),
+        scans={"outbox"},
+    )
+
+    def dead_letter():
+        outbox.dead_letter(conn.cursor(), 1, "bench", 0)
+        conn.commit()
+
+    recorder.run("dead_letter", dead_letter)
+    recorder.run(
+        "outbox_stats",
+        lambda: outbox.outbox_stats(conn),
+        scans={"outbox", "outbox_dead_letter"},
+    )
+    recorder.run("prune_applied_events", lambda: acker.prune_applied_events(conn))
+
+    def load_snapshot():
+        header = {"watermark": 20, "products": 2}
+        snapshot.load_snapshot(conn, 0, header, [b"[1, 5]", b"[2, 7]"])
+        conn.commit()
+
+    recorder.run("load_snapshot", load_snapshot)
+    recorder.run("snapshot_watermark", lambda: snapshot.snapshot_watermark(conn, 0))
+    recorder.run("StartupState.save", lambda: startup.startup_state.save(conn))
+    recorder.run("load_startup_state", lambda: startup.load_startup_state(conn))
+
+    conn.set_trace_callback(None)
+    failures = full_scans(conn, recorder.checked)
+    conn.close()
+    return failures
+
+
+def main():
+    cwd = os.getcwd()
+    failures, checked = [], 0
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            # Coalesce and retire the events published just now
+            os.environ["COALESCE_MIN_AGE_SECONDS"] = "0"
+            os.environ["EVENT_RETENTION_SECONDS"] = "0"
+            os.environ["EVENT_RETENTION_PAUSE_SECONDS"] = "0"
+            for plans in (sync_service_plans, api_plans):
+                recorder = Recorder()
+                failures += plans(recorder)
+                checked += len(
+                    {" ".join(sql.split()) for _, sql, _ in recorder.checked}
+                )
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+
+    for function, sql, details in failures:
+        print(f"FULL SCAN in {function}: {sql}")
+        for detail in details:
+            print(f"    {detail}")
+
+    print(f"{checked} hot queries checked, {len(failures)} with full scans")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+# Time to onboard a branch that misses every product.
+#
+# Compares, on a fresh branch database:
+#   replay   - apply one CREATE event per product with
+#              apply_events, one transaction per catch-up page
+#              (no HTTP: the real replay also fetches every page
+#              and acks every event)
+#   snapshot - stream GET /snapshot's lines from the sync
+#              database (snapshot_lines) and bulk-load them with
+#              load_snapshot in one transaction
+#
+# Usage: python bench/snapshot_bootstrap.py [--products 1000000]
+# ===================================================
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PAGE_SIZE = 500
+
+
+def load_module(service: str, name: str):
+    spec = importlib.util.spec_from_file_location(
+        f"{service}_{name}", os.path.join(ROOT, service, f"{name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Both services have database, partition and metrics modules: each
+# one's modules are loaded with its own in place
+def load_services():
+    sys.modules["partition"] = load_module("sync-service", "partition")
+    sys.modules["metrics"] = load_module("sync-service", "metrics")
+    sync_database = load_module("sync-service", "database")
+    sys.modules["database"] = sync_database
+    sys.modules["event_store"] = load_module("sync-service", "event_store")
+    sync_snapshot = load_module("sync-service", "snapshot")
+
+    sys.path.insert(0, os.path.join(ROOT, "api"))
+    sys.modules["partition"] = load_module("api", "partition")
+    sys.modules["metrics"] = load_module("api", "metrics")
+    api_database = load_module("api", "database")
+    sys.modules["database"] = api_database
+    api_snapshot = load_module("api", "snapshot")
+    api_event_handler = load_module("api", "event_handler")
+    models = load_module("api", "models")
+
+    return (
+        sync_database,
+        sync_snapshot,
+        api_database,
+        api_snapshot,
+        api_event_handler,
+        models,
+    )
+
+
+def replay(api_database, event_handler, models, products):
+    db = api_database.connect()
+    cursor = db.cursor()
+    for start in range(1, products + 1, PAGE_SIZE):
+        events = [
+            models.NotifyIn(
+                event_consumer_id=sub,
+                publisher_branch_id="a",
+                operation="CREATE",
+                sub=sub,
+                initial_balance=100,
+                current_balance=100,
+                delta=0,
+            )
+            for sub in range(start, min(start + PAGE_SIZE, products + 1))
+        ]
+        event_handler.apply_events(cursor, events, "b")
+        db.commit()
+    loaded = db.execute("SELECT COUNT(*) FROM product").fetchone()[0]
+    db.close()
+    return loaded
+
+
+def snapshot(api_database, api_snapshot, sync_snapshot, sync_path):
+    db = api_database.connect()
+    # The stream is split into lines like response.iter_lines()
+    lines = (
+        line
+        for chunk in sync_snapshot.snapshot_lines("b", database=sync_path)
+        for line in chunk.encode().splitlines()
+    )
+    header = json.loads(next(lines))
+    db.execute("BEGIN IMMEDIATE")
+    api_snapshot.load_snapshot(db, 0, header, lines)
+    db.commit()
+    loaded = db.execute("SELECT COUNT(*) FROM product").fetchone()[0]
+    db.close()
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            services = load_services()
+            sync_database, sync_snapshot, api_database, api_snapshot = services[:4]
+            event_handler, models = services[4:]
+
+            sync_path = os.path.join(tmp, "sync_database.db")
+            sync_database.start_database()
+            conn = sync_database.connect(sync_path)
+            conn.executemany(
+                "INSERT INTO product_balance (product_id, balance) VALUES (?, ?)",
+                ((sub, 100) for sub in range(1, args.products + 1)),
+            )
+            conn.commit()
+            conn.close()
+
+            print(f"{'mode':>9} {'products':>10} {'seconds':>9}")
+            for mode in ["replay", "snapshot"]:
+                api_path = os.path.join(tmp, mode)
+                os.mkdir(api_path)
+                os.chdir(api_path)
+                api_database.start_database()
+
+                start = time.perf_counter()
+                if mode == "replay":
+                    loaded = replay(api_database, event_handler, models, args.products)
+                else:
+                    loaded = snapshot(
+                        api_database, api_snapshot, sync_snapshot, sync_path
+                    )
+                elapsed = time.perf_counter() - start
+                print(f"{mode:>9} {loaded:>10} {elapsed:>9.2f}")
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
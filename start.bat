@@ -30,7 +30,7 @@ if %errorlevel% neq 0 (
 echo.
 echo Instalando dependencias do Sync Service...
 cd ..\sync-service
-pip install fastapi uvicorn requests pydantic
+pip install fastapi uvicorn httpx pydantic websockets
 if %errorlevel% neq 0 (
     echo ERRO: Falha ao instalar dependencias do Sync Service.
     pause
@@ -37,7 +37,7 @@ fi
 echo
 echo "Instalando dependências do Sync Service..."
 cd ../sync-service
-$PIP_CMD install fastapi uvicorn requests pydantic
+$PIP_CMD install fastapi uvicorn httpx pydantic websockets
 if [ $? -ne 0 ]; then
     echo "ERRO: Falha ao instalar dependências do Sync Service."
     exit 1
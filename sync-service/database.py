@@ -7,21 +7,294 @@
 # Computaçao Distribuída,
 # Novembro de 2025
 # ===================================================
+import os
+import queue
 import sqlite3
 
+from metrics import sqlite_commit_seconds, timed
+from partition import SYNC_PARTITION, SYNC_PARTITIONS
 
-def get_db():
-    conn = sqlite3.connect("sync_database.db")
+# Every partition keeps its own database
+DATABASE = (
+    "sync_database.db" if SYNC_PARTITIONS == 1 else f"sync_database_{SYNC_PARTITION}.db"
+)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+
+
+# At most one active lock per product. Older duplicates left by the
+# previous check-then-insert flow are released before the index exists.
+def add_lock_active_product_index(conn):
+    conn.execute("""
+        UPDATE lock SET released_at = CURRENT_TIMESTAMP
+        WHERE released_at IS NULL AND id NOT IN (
+            SELECT MAX(id) FROM lock WHERE released_at IS NULL GROUP BY product_id
+        )
+        """)
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS lock_active_product
+        ON lock (product_id) WHERE released_at IS NULL
+        """)
+
+
+# Databases created before delta coalescing lack the column
+def add_event_coalesced_into(conn):
+    event_columns = [row[1] for row in conn.execute("PRAGMA table_info(event)")]
+    if "coalesced_into" not in event_columns:
+        conn.execute(
+            "ALTER TABLE event ADD COLUMN coalesced_into INTEGER NULL REFERENCES event(id)"
+        )
+
+
+# Hot paths: catch-up and coalescing read the pending events of one
+# subscriber in id order; publisher lookups filter by publisher_id
+def add_event_hot_path_indexes(conn):
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS event_pending_subscriber
+        ON event (subscriber_id, id) WHERE consumed_at IS NULL
+        """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS event_publisher ON event (publisher_id)
+        """)
+
+
+# Retention walks the consumed events oldest first
+def add_event_consumed_at_index(conn):
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS event_consumed_at
+        ON event (consumed_at) WHERE consumed_at IS NOT NULL
+        """)
+
+
+# Current balance of every product, kept up to date by the publish
+# transaction and served as the bootstrap snapshot. It is only
+# complete when tracked since the first event: product_balance_since
+# holds the last event id published before the table existed.
+def add_product_balance(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS product_balance (
+            product_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL
+        )
+        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS product_balance_since (
+            event_id INTEGER NOT NULL
+        )
+        """)
+    last_event = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'event'"
+    ).fetchone()
+    conn.execute(
+        "INSERT INTO product_balance_since (event_id) VALUES (?)",
+        (last_event[0] if last_event else 0,),
+    )
+
+
+# ===================================================
+# Single event log with per-subscriber offsets:
+# 1. event_log stores each event once, numbered by seq; target_id
+# is NULL for events delivered to every other subscriber, or the
+# only subscriber a row is addressed to (coalesced events)
+# 2. subscriber.committed_seq: every event up to it is consumed
+# by that subscriber; acks above it wait in subscriber_ack
+# until the offset passes them
+# 3. Legacy pending rows move to the log with their ids (the
+# branches recorded those ids), addressed to their subscriber,
+# and new seqs continue after the last legacy id. Consumed rows
+# stay in the legacy event table until retention drains it.
+# ===================================================
+def add_event_log(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            publisher_id TEXT,
+            target_id TEXT NULL,
+            published_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            operation TEXT,
+            sub INTEGER,
+            initial_balance INTEGER,
+            current_balance INTEGER,
+            delta INTEGER,
+            FOREIGN KEY (publisher_id) REFERENCES subscriber(id),
+            FOREIGN KEY (target_id) REFERENCES subscriber(id)
+        )
+        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriber_ack (
+            subscriber_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (subscriber_id, seq)
+        ) WITHOUT ROWID
+        """)
+    conn.execute(
+        "ALTER TABLE subscriber ADD COLUMN committed_seq INTEGER NOT NULL DEFAULT 0"
+    )
+
+    conn.execute("""
+        INSERT INTO event_log (seq, publisher_id, target_id, published_at, operation, sub, initial_balance, current_balance, delta)
+        SELECT id, publisher_id, subscriber_id, published_at, operation, sub, initial_balance, current_balance, delta
+        FROM event WHERE consumed_at IS NULL
+        """)
+    last_event = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'event'"
+    ).fetchone()
+    last_id = last_event[0] if last_event else 0
+    if last_id:
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'event_log'")
+        conn.execute(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('event_log', ?)",
+            (last_id,),
+        )
+    conn.execute(
+        """
+        UPDATE subscriber SET committed_seq = COALESCE(
+            (SELECT MIN(id) - 1 FROM event
+             WHERE subscriber_id = subscriber.id AND consumed_at IS NULL),
+            ?
+        )
+        """,
+        (last_id,),
+    )
+    conn.execute("DELETE FROM event WHERE consumed_at IS NULL")
+
+
+# A coalesced event lists the [seq, delta] of the UPDATEs merged
+# into it, so a branch that already applied some of them (acks
+# not sent yet) only applies the deltas of the others
+def add_event_log_coalesced(conn):
+    conn.execute("ALTER TABLE event_log ADD COLUMN coalesced TEXT NULL")
+
+
+# Idempotency key sent by the publisher with each event, so a
+# retried publish is stored once. Keys leave with their events
+# (retention), long after any retry.
+def add_event_log_event_key(conn):
+    conn.execute("ALTER TABLE event_log ADD COLUMN event_key TEXT NULL")
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS event_log_event_key
+        ON event_log (event_key) WHERE event_key IS NOT NULL
+        """)
+
+
+# ===================================================
+# Versioned schema migrations:
+# 1. PRAGMA user_version holds the number of migrations applied
+# 2. Pending migrations run in order, each in its own transaction
+# 3. New migrations are only ever appended to this list
+# ===================================================
+MIGRATIONS = [
+    add_lock_active_product_index,
+    add_event_coalesced_into,
+    add_event_hot_path_indexes,
+    add_event_consumed_at_index,
+    add_product_balance,
+    add_event_log,
+    add_event_log_coalesced,
+    add_event_log_event_key,
+]
+
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Migration {number} applied: {migration.__name__}")
+
+
+# Connection that times every commit (sqlite_commit_duration_seconds)
+class TimedConnection(sqlite3.Connection):
+    def commit(self):
+        with timed(sqlite_commit_seconds):
+            super().commit()
+
+
+# ===================================================
+# Open a tuned connection:
+# 1. busy_timeout makes a writer wait for the lock instead of
+# failing at once with "database is locked"
+# 2. synchronous=NORMAL is durable with WAL and skips the fsync
+# on every commit
+# 3. Up to DB_CACHED_STATEMENTS prepared statements are reused
+# Usable from any thread, but by one thread at a time.
+# ===================================================
+def connect(database: str = DATABASE):
+    conn = sqlite3.connect(
+        database,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+        factory=TimedConnection,
+    )
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
     conn.row_factory = sqlite3.Row
+    return conn
+
+
+# ===================================================
+# Pool of open connections shared by the request threads:
+# 1. acquire() reuses the most recently returned connection
+# (warm page and statement caches) or opens a new one
+# 2. release() rolls back whatever the request left open and
+# keeps up to `size` idle connections, closing the rest
+# A request holds its connection from the dependency until the
+# response is sent, even when FastAPI moves it between threads.
+# ===================================================
+class ConnectionPool:
+    def __init__(self, database: str, size: int):
+        self.database = database
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect(self.database)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self.idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+
+
+pool = ConnectionPool(DATABASE, DB_POOL_SIZE)
+
+
+def get_db():
+    conn = pool.acquire()
 
     try:
         yield conn
     finally:
-        conn.close()
+        pool.release(conn)
 
 
 def start_database():
-    conn = sqlite3.connect("sync_database.db")
+    conn = connect()
+    # Readers do not block the writer (and vice versa); the mode is
+    # stored in the database file
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    # Pages freed by event retention can be given back to the file
+    # system (PRAGMA incremental_vacuum). Existing databases only
+    # switch after a full VACUUM, done once here.
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
 
     conn.execute("""
         CREATE TABLE IF NOT EXISTS subscriber (
@@ -42,13 +315,14 @@ def start_database():
             initial_balance INTEGER,
             current_balance INTEGER,
             delta INTEGER,
+            coalesced_into INTEGER NULL,
             FOREIGN KEY (publisher_id) REFERENCES subscriber(id),
-            FOREIGN KEY (subscriber_id) REFERENCES subscriber(id)
+            FOREIGN KEY (subscriber_id) REFERENCES subscriber(id),
+            FOREIGN KEY (coalesced_into) REFERENCES event(id)
         )
         """)
 
-    conn.execute(
-        """
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS lock (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             branch TEXT NOT NULL,
@@ -56,7 +330,8 @@ def start_database():
             locked_at TEXT DEFAULT CURRENT_TIMESTAMP,
             released_at TEXT
         )
-        """
-    )
+        """)
     conn.commit()
+
+    migrate(conn)
     conn.close()
@@ -0,0 +1,354 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import json
+import os
+from sqlite3 import Connection, Cursor
+
+from partition import next_seq
+
+COALESCE_MIN_AGE_SECONDS = int(os.getenv("COALESCE_MIN_AGE_SECONDS", "60"))
+# Event ids per statement, below the SQLite limit on bound variables
+CONSUME_CHUNK_SIZE = 500
+
+# Events of one subscriber's stream: not its own, and either
+# broadcast or addressed to it
+SUBSCRIBER_STREAM = (
+    "publisher_id != :subscriber AND (target_id IS NULL OR target_id = :subscriber)"
+)
+NOT_ACKED = (
+    "NOT EXISTS (SELECT 1 FROM subscriber_ack a "
+    "WHERE a.subscriber_id = :subscriber AND a.seq = event_log.seq)"
+)
+
+
+def update_balance(cursor: Cursor, event: dict):
+    if event["operation"] == "CREATE":
+        cursor.execute(
+            "INSERT OR IGNORE INTO product_balance (product_id, balance) VALUES (?, ?)",
+            (event["sub"], event["initial_balance"]),
+        )
+    elif event["operation"] == "UPDATE":
+        # A product created before balances were tracked starts
+        # from the publisher's balance
+        cursor.execute(
+            """
+            INSERT INTO product_balance (product_id, balance) VALUES (?, ?)
+            ON CONFLICT (product_id) DO UPDATE SET balance = balance + ?
+            """,
+            (event["sub"], event["current_balance"], event["delta"]),
+        )
+
+
+# Last seq assigned (0 while the log is empty)
+def head_seq(db: Connection):
+    last = db.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'event_log'"
+    ).fetchone()
+    return last[0] if last else 0
+
+
+def committed_seq(db: Connection, subscriber_id: str):
+    row = db.execute(
+        "SELECT committed_seq FROM subscriber WHERE id = ?", (subscriber_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+# ===================================================
+# Store a batch of events in the log, once each:
+# 1. One row per event, whatever the number of branches; every
+# subscriber but the publisher reads it through its offset
+# 2. One commit (one fsync) for the whole batch
+# 3. The product's balance in product_balance is updated in the
+# same transaction, so a snapshot always matches a seq
+# 4. The publisher's own offset moves past the batch when it has
+# nothing pending before it
+# 5. Seqs are taken from this partition's share (see partition.py),
+# reading the head seq only once the write lock is held, so two
+# concurrent writers never pick the same seq
+# 6. An event whose event_key is already in the log is skipped: a
+# publish that committed here but timed out at the branch is
+# retried, and must not be applied twice by the other branches
+# Returns [(seq, event), ...] of the new events, in publish order,
+# and the (subscriber_id, branch_url) of every subscriber to
+# deliver to.
+# ===================================================
+def fan_out_events(db: Connection, publisher_id: str, events: list):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        result = store_in_log(db.cursor(), publisher_id, events)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return result
+
+
+def store_in_log(cursor: Cursor, publisher_id: str, events: list):
+    stored = []
+    for event in events:
+        event_key = event.get("event_key")
+        if (
+            event_key is not None
+            and cursor.execute(
+                "SELECT 1 FROM event_log WHERE event_key = ?", (event_key,)
+            ).fetchone()
+        ):
+            continue
+
+        update_balance(cursor, event)
+        seq = cursor.execute(
+            """
+            INSERT INTO event_log (seq, publisher_id, operation, sub, initial_balance, current_balance, delta, event_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                next_seq(head_seq(cursor.connection)),
+                publisher_id,
+                event["operation"],
+                event["sub"],
+                event["initial_balance"],
+                event["current_balance"],
+                event["delta"],
+                event_key,
+            ),
+        ).lastrowid
+        stored.append((seq, event))
+
+    subscribers = cursor.execute(
+        "SELECT id, branch_url FROM subscriber WHERE id != ?", (publisher_id,)
+    ).fetchall()
+    # Nobody acks the publisher's own events: move its offset past
+    # them, or a branch that only publishes would hold back retention
+    advance_offset(cursor, publisher_id)
+
+    return stored, [
+        (subscriber_id, branch_url) for subscriber_id, branch_url in subscribers
+    ]
+
+
+# ===================================================
+# Move a subscriber's offset forward:
+# 1. The offset stops just before the first event of its stream
+# that is not acked yet (or at the head of the log when there
+# is none), so events of other branches and its own events never
+# hold it back
+# 2. Acks at or below the new offset are no longer needed
+# Runs inside the caller's transaction. Returns the new offset.
+# ===================================================
+def advance_offset(cursor: Cursor, subscriber_id: str):
+    offset = committed_seq(cursor.connection, subscriber_id)
+    if offset is None:
+        return None
+
+    first_pending = cursor.execute(
+        f"""
+        SELECT MIN(seq) FROM event_log
+        WHERE seq > :offset AND {SUBSCRIBER_STREAM} AND {NOT_ACKED}
+        """,
+        {"offset": offset, "subscriber": subscriber_id},
+    ).fetchone()[0]
+    new_offset = (
+        first_pending - 1 if first_pending is not None else head_seq(cursor.connection)
+    )
+
+    if new_offset > offset:
+        cursor.execute(
+            "UPDATE subscriber SET committed_seq = ? WHERE id = ?",
+            (new_offset, subscriber_id),
+        )
+        cursor.execute(
+            "DELETE FROM subscriber_ack WHERE subscriber_id = ? AND seq <= ?",
+            (subscriber_id, new_offset),
+        )
+        return new_offset
+    return offset
+
+
+# ===================================================
+# A subscriber's non-consumed events, after `after_seq`, in seq
+# order: past its offset and not acked. Rows keep the shape of
+# the old per-subscriber rows (id, publisher_id, ...).
+# ===================================================
+def pending_events(db: Connection, subscriber_id: str, after_seq: int, limit: int):
+    offset = committed_seq(db, subscriber_id)
+    if offset is None:
+        return []
+
+    return db.execute(
+        f"""
+        SELECT seq AS id, publisher_id, published_at, operation, sub, initial_balance, current_balance, delta, coalesced
+        FROM event_log
+        WHERE seq > :after AND {SUBSCRIBER_STREAM} AND {NOT_ACKED}
+        ORDER BY seq LIMIT :limit
+        """,
+        {"after": max(after_seq, offset), "subscriber": subscriber_id, "limit": limit},
+    ).fetchall()
+
+
+# ===================================================
+# Delta coalescing of a subscriber's pending UPDATE events:
+# 1. Its non-consumed UPDATEs of the same product are merged into
+# a single event carrying the net delta, appended to the log and
+# addressed to that subscriber only
+# 2. The originals are acked for that subscriber, so its offset
+# moves past them; the other subscribers still read them
+# 3. Only events older than COALESCE_MIN_AGE_SECONDS are merged,
+# so a /notify delivery still in flight is rarely merged
+# 4. The merged event lists the [seq, delta] of its originals
+# (column coalesced): the branch may have applied some of them
+# already, without its acks reaching us, and only applies the
+# deltas of the others (see apply_events in the API). An event
+# merged by an earlier pass is replaced by its own originals, so
+# the list always holds the events published by the branches
+# 5. Read, merge and ack run under the write lock, so two
+# concurrent catch-ups never merge the same originals twice
+# A branch catching up after an outage then receives one UPDATE
+# per product touched instead of one per order placed.
+# Returns the number of events merged away.
+# ===================================================
+def coalesce_pending_updates(db: Connection, subscriber_id: str):
+    cursor = db.cursor()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        merged = merge_pending_updates(cursor, subscriber_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return merged
+
+
+def merge_pending_updates(cursor: Cursor, subscriber_id: str):
+    offset = committed_seq(cursor.connection, subscriber_id)
+    if offset is None:
+        return 0
+
+    pending_updates = f"""
+        seq > :offset AND {SUBSCRIBER_STREAM} AND {NOT_ACKED}
+        AND operation = 'UPDATE' AND published_at <= datetime('now', :age)
+        """
+    params = {
+        "offset": offset,
+        "subscriber": subscriber_id,
+        "age": f"-{COALESCE_MIN_AGE_SECONDS} seconds",
+    }
+    groups = cursor.execute(
+        f"""
+        SELECT sub, COUNT(*), SUM(delta), MAX(seq) FROM event_log
+        WHERE {pending_updates}
+        GROUP BY sub HAVING COUNT(*) > 1
+        """,
+        params,
+    ).fetchall()
+
+    merged = 0
+    for sub, count, delta, last_seq in groups:
+        rows = cursor.execute(
+            f"""
+            SELECT seq, delta, coalesced FROM event_log
+            WHERE {pending_updates} AND sub = :sub AND seq <= :last_seq
+            ORDER BY seq
+            """,
+            {**params, "sub": sub, "last_seq": last_seq},
+        ).fetchall()
+        # An event merged by an earlier pass lists its own originals:
+        # those are the ones the branch may have applied
+        originals = []
+        for seq, original, coalesced in rows:
+            if coalesced is not None:
+                originals.extend(json.loads(coalesced))
+            else:
+                originals.append([seq, original])
+        cursor.execute(
+            """
+            INSERT INTO event_log (seq, publisher_id, target_id, operation, sub, initial_balance, current_balance, delta, coalesced)
+            SELECT ?, publisher_id, ?, operation, sub, initial_balance, current_balance, ?, ?
+            FROM event_log WHERE seq = ?
+            """,
+            (
+                next_seq(head_seq(cursor.connection)),
+                subscriber_id,
+                delta,
+                json.dumps(originals),
+                last_seq,
+            ),
+        )
+        cursor.executemany(
+            "INSERT OR IGNORE INTO subscriber_ack (subscriber_id, seq) VALUES (?, ?)",
+            [(subscriber_id, seq) for seq, _, _ in rows],
+        )
+        merged += count
+
+    if merged:
+        advance_offset(cursor, subscriber_id)
+    return merged
+
+
+# ===================================================
+# Ack a batch of a subscriber's events:
+# 1. Acks above the offset are recorded in subscriber_ack, one
+# INSERT per chunk of ids; acks at or below it are no-ops, so a
+# repeated ack is harmless
+# 2. The offset then moves past every contiguous acked event
+# All in a single transaction and commit.
+# Returns the number of events newly acked.
+# ===================================================
+def consume_events(db: Connection, subscriber_id: str, event_ids: list):
+    cursor = db.cursor()
+    offset = committed_seq(db, subscriber_id)
+    if offset is None:
+        return 0
+
+    seqs = sorted({seq for seq in event_ids if seq > offset})
+    consumed = 0
+    for start in range(0, len(seqs), CONSUME_CHUNK_SIZE):
+        chunk = seqs[start : start + CONSUME_CHUNK_SIZE]
+        consumed += cursor.execute(
+            f"""
+            INSERT OR IGNORE INTO subscriber_ack (subscriber_id, seq)
+            SELECT ?, seq FROM event_log WHERE seq IN ({', '.join('?' * len(chunk))})
+            """,
+            (subscriber_id, *chunk),
+        ).rowcount
+
+    advance_offset(cursor, subscriber_id)
+    db.commit()
+    return consumed
+
+
+# Every event of a subscriber up to `watermark` is consumed: they
+# are already reflected in the snapshot it loaded.
+# Returns the number of events that were still pending.
+def consume_events_through(db: Connection, subscriber_id: str, watermark: int):
+    cursor = db.cursor()
+    offset = committed_seq(db, subscriber_id)
+    if offset is None or watermark <= offset:
+        return 0
+
+    consumed = cursor.execute(
+        f"""
+        SELECT COUNT(*) FROM event_log
+        WHERE seq > :offset AND seq <= :watermark AND {SUBSCRIBER_STREAM} AND {NOT_ACKED}
+        """,
+        {"offset": offset, "watermark": watermark, "subscriber": subscriber_id},
+    ).fetchone()[0]
+    cursor.execute(
+        "UPDATE subscriber SET committed_seq = ? WHERE id = ?",
+        (watermark, subscriber_id),
+    )
+    cursor.execute(
+        "DELETE FROM subscriber_ack WHERE subscriber_id = ? AND seq <= ?",
+        (subscriber_id, watermark),
+    )
+    advance_offset(cursor, subscriber_id)
+
+    db.commit()
+    return consumed
@@ -0,0 +1,263 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import heapq
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from database import DATABASE, connect
+from metrics import Histogram
+
+LOCK_TTL_SECONDS = float(os.getenv("LOCK_TTL_SECONDS", "30"))
+
+lock_hold_seconds = Histogram(
+    "lock_hold_duration_seconds",
+    "Time a product stays locked, by how the lock ended (released or expired).",
+    ("outcome",),
+)
+
+
+@dataclass
+class Lease:
+    id: int
+    branch: str
+    product_id: int
+    locked_at: str
+    expires_at: float
+    acquired_at: float = 0.0
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "branch": self.branch,
+            "product_id": self.product_id,
+            "locked_at": self.locked_at,
+            "expires_in": max(self.expires_at - time.monotonic(), 0),
+        }
+
+
+def now_timestamp():
+    # Same format as SQLite CURRENT_TIMESTAMP
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ===================================================
+# Audit trail of the lock table.
+# Lock operations are queued and written by a single
+# background thread, so they never wait on the disk.
+# ===================================================
+class LockAuditTrail:
+    def __init__(self, database: str):
+        self.database = database
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.write_forever, name="lock-audit", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def record(self, operation: str, lease: Lease):
+        self.pending.put((operation, lease, now_timestamp()))
+
+    # Writes a batch of operations in one transaction
+    def write(self, conn, batch: list):
+        try:
+            for operation, lease, timestamp in batch:
+                if operation == "ACQUIRE":
+                    # The lock manager holds one lease per product: a
+                    # row still open here lost its RELEASE, and would
+                    # block this insert (unique index lock_active_product)
+                    conn.execute(
+                        "UPDATE lock SET released_at = ? WHERE product_id = ? AND released_at IS NULL",
+                        (timestamp, lease.product_id),
+                    )
+                    conn.execute(
+                        "INSERT INTO lock (id, branch, product_id, locked_at) VALUES (?, ?, ?, ?)",
+                        (lease.id, lease.branch, lease.product_id, timestamp),
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE lock SET released_at = ? WHERE id = ?",
+                        (timestamp, lease.id),
+                    )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def write_forever(self):
+        conn = connect(self.database)
+
+        while True:
+            batch = [self.pending.get()]
+            while not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+
+            try:
+                self.write(conn, batch)
+            except Exception as e:
+                print(f"Lock audit batch failed, retrying one by one: {str(e)}")
+                # One bad operation only loses itself, not the batch
+                for operation in batch:
+                    try:
+                        self.write(conn, [operation])
+                    except Exception as e:
+                        print(
+                            f"Lock audit dropped {operation[0]} of lock {operation[1].id}: {str(e)}"
+                        )
+
+
+# ===================================================
+# In-memory lease-based lock manager:
+# 1. Active locks live in a dict keyed by product_id (O(1) checks)
+# 2. Each lock is a lease that expires after its TTL, so a
+# crashed branch can not keep a product locked forever
+# 3. Expiry uses a heap ordered by deadline; expired leases
+# are dropped before every operation
+# ===================================================
+class LockManager:
+    def __init__(self, next_lock_id: int, audit: LockAuditTrail):
+        self.mutex = threading.Lock()
+        self.by_product = {}
+        self.by_id = {}
+        self.deadlines = []
+        self.next_lock_id = next_lock_id
+        self.audit = audit
+
+    def expire(self, now: float):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, lock_id = heapq.heappop(self.deadlines)
+            lease = self.by_id.get(lock_id)
+            # Renewed leases leave their old deadline behind in the heap
+            if lease is None or lease.expires_at > now:
+                continue
+            del self.by_id[lock_id]
+            del self.by_product[lease.product_id]
+            self.audit.record("EXPIRE", lease)
+            lock_hold_seconds.observe(now - lease.acquired_at, outcome="expired")
+            print(f"Lock {lock_id} expired")
+
+    def get(self, product_id: int) -> Optional[Lease]:
+        with self.mutex:
+            self.expire(time.monotonic())
+            return self.by_product.get(product_id)
+
+    def grant(self, product_id: int, branch: str, ttl: Optional[float], now: float):
+        lease = Lease(
+            id=self.next_lock_id,
+            branch=branch,
+            product_id=product_id,
+            locked_at=now_timestamp(),
+            expires_at=now + (ttl if ttl is not None else LOCK_TTL_SECONDS),
+            acquired_at=now,
+        )
+        self.next_lock_id += 1
+        self.by_product[product_id] = lease
+        self.by_id[lease.id] = lease
+        heapq.heappush(self.deadlines, (lease.expires_at, lease.id))
+        # Recorded under the mutex so the audit keeps the real order
+        self.audit.record("ACQUIRE", lease)
+        return lease
+
+    def acquire(
+        self, product_id: int, branch: str, ttl: Optional[float] = None
+    ) -> Optional[Lease]:
+        with self.mutex:
+            now = time.monotonic()
+            self.expire(now)
+            if product_id in self.by_product:
+                return None
+            return self.grant(product_id, branch, ttl, now)
+
+    # Locks several products at once, in ascending product id order.
+    # Returns (leases, conflicts); with all_or_nothing nothing is
+    # locked when any product is already taken.
+    def acquire_many(
+        self,
+        product_ids: list,
+        branch: str,
+        ttl: Optional[float] = None,
+        all_or_nothing: bool = True,
+    ):
+        with self.mutex:
+            now = time.monotonic()
+            self.expire(now)
+            product_ids = sorted(set(product_ids))
+            conflicts = [p for p in product_ids if p in self.by_product]
+            if conflicts and all_or_nothing:
+                return [], conflicts
+
+            leases = [
+                self.grant(product_id, branch, ttl, now)
+                for product_id in product_ids
+                if product_id not in self.by_product
+            ]
+            return leases, conflicts
+
+    def renew(self, lock_id: int, ttl: Optional[float] = None) -> Optional[Lease]:
+        with self.mutex:
+            now = time.monotonic()
+            self.expire(now)
+            lease = self.by_id.get(lock_id)
+            if lease is None:
+                return None
+
+            lease.expires_at = now + (ttl if ttl is not None else LOCK_TTL_SECONDS)
+            heapq.heappush(self.deadlines, (lease.expires_at, lease.id))
+            return lease
+
+    def release(self, lock_id: int) -> Optional[Lease]:
+        with self.mutex:
+            now = time.monotonic()
+            self.expire(now)
+            lease = self.by_id.pop(lock_id, None)
+            if lease is None:
+                return None
+            del self.by_product[lease.product_id]
+            self.audit.record("RELEASE", lease)
+            lock_hold_seconds.observe(now - lease.acquired_at, outcome="released")
+            return lease
+
+    # Returns (released, not_found) lock ids
+    def release_many(self, lock_ids: list):
+        released, not_found = [], []
+        with self.mutex:
+            now = time.monotonic()
+            self.expire(now)
+            for lock_id in lock_ids:
+                lease = self.by_id.pop(lock_id, None)
+                if lease is None:
+                    not_found.append(lock_id)
+                    continue
+                del self.by_product[lease.product_id]
+                self.audit.record("RELEASE", lease)
+                lock_hold_seconds.observe(now - lease.acquired_at, outcome="released")
+                released.append(lock_id)
+        return released, not_found
+
+
+def start_lock_manager(database: str = DATABASE) -> LockManager:
+    conn = connect(database)
+    # Leases do not survive a restart: close whatever the last run left open
+    conn.execute(
+        "UPDATE lock SET released_at = CURRENT_TIMESTAMP WHERE released_at IS NULL"
+    )
+    conn.commit()
+    last_lock_id = conn.execute("SELECT MAX(id) FROM lock").fetchone()[0] or 0
+    conn.close()
+
+    audit = LockAuditTrail(database)
+    audit.start()
+    return LockManager(next_lock_id=last_lock_id + 1, audit=audit)
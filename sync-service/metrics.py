@@ -0,0 +1,199 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# Starlette appends "; charset=utf-8" to text media types
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = ""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# ===================================================
+# Minimal Prometheus metrics, kept in memory by this process:
+# 1. A series per combination of label values, created on first use
+# 2. Updating a series is a dict lookup (and a bisect for a
+# histogram) under a mutex, cheap enough for every request
+# 3. render() writes every metric in the Prometheus text format
+# ===================================================
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.mutex = threading.Lock()
+        self.series = {}
+        registry.append(self)
+
+    def key(self, labels: dict):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self.mutex:
+            series = {key: self.snapshot(value) for key, value in self.series.items()}
+        for key, value in sorted(series.items()):
+            lines.extend(self.render_series(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.mutex:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def snapshot(self, value):
+        return value
+
+    def render_series(self, key: tuple, value):
+        return [f"{self.name}{format_labels(self.labels, key)} {value}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, labels: tuple = (), buckets=LATENCY_BUCKETS
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.mutex:
+            series = self.series.get(key)
+            if series is None:
+                # Count per bucket (the last one is +Inf), sum
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self, value):
+        return list(value[0]), value[1]
+
+    def render_series(self, key: tuple, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = format_labels(self.labels, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# Observes the seconds spent in the block, also when it raises
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, by route template and status.",
+    ("method", "path", "status"),
+)
+sqlite_commit_seconds = Histogram(
+    "sqlite_commit_duration_seconds", "Time of each SQLite commit."
+)
+event_fan_out_seconds = Histogram(
+    "event_fan_out_duration_seconds",
+    "Time of each event fan-out stage: store (log write), "
+    "notify (/notify call) and stream (frame send).",
+    ("stage",),
+)
+
+
+# ===================================================
+# ASGI middleware timing every HTTP request, labelled with the
+# route template (e.g. /product/{id}), so ids do not create a
+# series each. WebSockets are not timed.
+# ===================================================
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                path=route.path if route is not None else "unmatched",
+                status=status[0],
+            )
@@ -7,11 +7,33 @@
 # Computaçao Distribuída,
 # Novembro de 2025
 # ===================================================
-from typing import List
+from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class LockProductIn(BaseModel):
     product_id: int
     branch: str
+    ttl_seconds: Optional[float] = Field(default=None, gt=0)
+
+
+class LockBatchIn(BaseModel):
+    product_ids: List[int]
+    branch: str
+    all_or_nothing: bool = True
+    ttl_seconds: Optional[float] = Field(default=None, gt=0)
+
+
+class LockReleaseBatchIn(BaseModel):
+    lock_ids: List[int]
+
+
+class ConsumeBatchIn(BaseModel):
+    branch_id: str
+    event_ids: List[int]
+
+
+class ConsumeThroughIn(BaseModel):
+    branch_id: str
+    watermark: int
@@ -0,0 +1,71 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import asyncio
+import os
+
+import httpx
+from metrics import event_fan_out_seconds, timed
+from stream import stream_hub
+
+NOTIFY_MAX_WORKERS = int(os.getenv("NOTIFY_MAX_WORKERS", "16"))
+NOTIFY_TIMEOUT_SECONDS = float(os.getenv("NOTIFY_TIMEOUT_SECONDS", "5"))
+NOTIFY_CONNECT_TIMEOUT_SECONDS = float(os.getenv("NOTIFY_CONNECT_TIMEOUT_SECONDS", "2"))
+
+# Shared keep-alive client: one open connection per branch is
+# reused by every notification instead of a new TCP handshake
+client = httpx.AsyncClient(
+    timeout=httpx.Timeout(
+        NOTIFY_TIMEOUT_SECONDS, connect=NOTIFY_CONNECT_TIMEOUT_SECONDS
+    ),
+    limits=httpx.Limits(
+        max_connections=NOTIFY_MAX_WORKERS,
+        max_keepalive_connections=NOTIFY_MAX_WORKERS,
+    ),
+)
+in_flight = asyncio.Semaphore(NOTIFY_MAX_WORKERS)
+# Strong references, so pending deliveries are not garbage collected
+deliveries_running = set()
+
+
+async def deliver(branch_url: str, payload: list):
+    async with in_flight:
+        try:
+            with timed(event_fan_out_seconds, stage="notify"):
+                result = await client.post(f"{branch_url}/notify", json=payload)
+            print(f"notify result: {branch_url} {len(payload)} {result.status_code}")
+        except httpx.HTTPError as e:
+            # The events stay non-consumed and are replayed when the branch restarts
+            print(f"notify failed: {branch_url} {str(e)}")
+
+
+# ===================================================
+# Fan-out notifications to every subscriber concurrently:
+# 1. A subscriber with an open stream gets the events queued on
+# it (see stream.py)
+# 2. Otherwise it gets its list of events in one /notify call,
+# when it has an HTTP URL; a branch without one catches up
+# when it reconnects
+# Deliveries are tasks on the event loop (at most
+# NOTIFY_MAX_WORKERS at once), so the caller returns as soon
+# as the events are stored. Must be called from the event loop.
+# ===================================================
+def notify_subscribers(deliveries: list):
+    for subscriber_id, branch_url, payload in deliveries:
+        if stream_hub.push(subscriber_id, payload):
+            continue
+        if not branch_url.startswith(("http://", "https://")):
+            continue
+        task = asyncio.create_task(deliver(branch_url, payload))
+        deliveries_running.add(task)
+        task.add_done_callback(deliveries_running.discard)
+
+
+async def close_notifier():
+    await client.aclose()
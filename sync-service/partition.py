@@ -0,0 +1,54 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+
+# The sync service can run as SYNC_PARTITIONS processes; this one
+# is partition SYNC_PARTITION (0 .. SYNC_PARTITIONS - 1) and owns
+# the products with product_id % SYNC_PARTITIONS == SYNC_PARTITION:
+# their locks, their events and their balances
+SYNC_PARTITIONS = int(os.getenv("SYNC_PARTITIONS", "1"))
+SYNC_PARTITION = int(os.getenv("SYNC_PARTITION", "0"))
+SYNC_PORT = int(os.getenv("PORT", str(4000 + SYNC_PARTITION)))
+
+if not 0 <= SYNC_PARTITION < SYNC_PARTITIONS:
+    raise ValueError(
+        f"SYNC_PARTITION={SYNC_PARTITION} out of range for "
+        f"SYNC_PARTITIONS={SYNC_PARTITIONS}"
+    )
+
+
+def partition_of(product_id: int):
+    return product_id % SYNC_PARTITIONS
+
+
+# Products in `product_ids` owned by another partition
+def foreign_products(product_ids):
+    return sorted(
+        {
+            product_id
+            for product_id in product_ids
+            if partition_of(product_id) != SYNC_PARTITION
+        }
+    )
+
+
+# ===================================================
+# Next event seq of this partition. Seqs are still increasing in
+# the partition's own log, but partition p only uses seqs with
+# seq % SYNC_PARTITIONS == p, so event ids are unique across the
+# partitions and a branch routes an ack by its id alone.
+# `head` is the last seq assigned (0 while the log is empty).
+# ===================================================
+def next_seq(head: int):
+    return head + 1 + (SYNC_PARTITION - head - 1) % SYNC_PARTITIONS
+
+
+def to_dict():
+    return {"partition": SYNC_PARTITION, "partitions": SYNC_PARTITIONS}
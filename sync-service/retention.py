@@ -0,0 +1,338 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlite3 import Connection
+from typing import Optional
+
+from database import DATABASE, connect
+from event_store import head_seq
+from partition import SYNC_PARTITION, SYNC_PARTITIONS
+
+# archive: move to EVENT_ARCHIVE_DATABASE, delete: drop, off: keep forever
+EVENT_RETENTION_MODE = os.getenv("EVENT_RETENTION_MODE", "archive")
+EVENT_RETENTION_SECONDS = int(os.getenv("EVENT_RETENTION_SECONDS", "604800"))
+EVENT_RETENTION_MAX_CONSUMED = int(os.getenv("EVENT_RETENTION_MAX_CONSUMED", "100000"))
+EVENT_RETENTION_BATCH_SIZE = int(os.getenv("EVENT_RETENTION_BATCH_SIZE", "500"))
+EVENT_RETENTION_INTERVAL_SECONDS = float(
+    os.getenv("EVENT_RETENTION_INTERVAL_SECONDS", "60")
+)
+EVENT_RETENTION_PAUSE_SECONDS = float(
+    os.getenv("EVENT_RETENTION_PAUSE_SECONDS", "0.05")
+)
+EVENT_ARCHIVE_DATABASE = os.getenv(
+    "EVENT_ARCHIVE_DATABASE",
+    "sync_archive.db" if SYNC_PARTITIONS == 1 else f"sync_archive_{SYNC_PARTITION}.db",
+)
+# Free pages given back to the file system per incremental_vacuum step
+VACUUM_STEP_PAGES = 256
+
+EVENT_COLUMNS = (
+    "id, publisher_id, subscriber_id, published_at, consumed_at, operation, "
+    "sub, initial_balance, current_balance, delta, coalesced_into"
+)
+EVENT_LOG_COLUMNS = (
+    "seq, publisher_id, target_id, published_at, operation, "
+    "sub, initial_balance, current_balance, delta, coalesced, event_key"
+)
+# Columns added to archive.event_log after it was first created
+ARCHIVE_EVENT_LOG_ADDED_COLUMNS = {"coalesced": "TEXT", "event_key": "TEXT"}
+
+# Consumed rows of each table, oldest first: (key, age) of a batch
+# and the total count. Legacy per-subscriber rows age from
+# consumed_at; log events from published_at, below the floor.
+RETAINED_TABLES = [
+    {
+        "table": "event",
+        "key": "id",
+        "columns": EVENT_COLUMNS,
+        "expired": """
+            SELECT id, consumed_at FROM event WHERE consumed_at IS NOT NULL
+            ORDER BY consumed_at LIMIT :limit
+            """,
+        "consumed": "SELECT COUNT(*) FROM event WHERE consumed_at IS NOT NULL",
+    },
+    {
+        "table": "event_log",
+        "key": "seq",
+        "columns": EVENT_LOG_COLUMNS,
+        "expired": """
+            SELECT seq, published_at FROM event_log WHERE seq <= :floor
+            ORDER BY seq LIMIT :limit
+            """,
+        "consumed": "SELECT COUNT(*) FROM event_log WHERE seq <= :floor",
+    },
+]
+
+
+def now_timestamp(offset_seconds: float = 0):
+    # Same format as SQLite CURRENT_TIMESTAMP
+    moment = datetime.utcnow() + timedelta(seconds=offset_seconds)
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def database_size(db: Connection):
+    page_size = db.execute("PRAGMA page_size").fetchone()[0]
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_count * page_size, freelist_count * page_size
+
+
+# Every log event at or below the lowest subscriber offset has
+# been consumed by every branch (the head when nobody subscribes)
+def consumed_floor(db: Connection):
+    lowest = db.execute("SELECT MIN(committed_seq) FROM subscriber").fetchone()[0]
+    return lowest if lowest is not None else head_seq(db)
+
+
+# Row counts and file size of the event log, for GET /event/retention
+def event_table_stats(db: Connection):
+    floor = consumed_floor(db)
+    log_events = db.execute("SELECT COUNT(*) FROM event_log").fetchone()[0]
+    consumed = db.execute(
+        "SELECT COUNT(*) FROM event_log WHERE seq <= ?", (floor,)
+    ).fetchone()[0]
+    legacy = db.execute("SELECT COUNT(*) FROM event").fetchone()[0]
+    database_bytes, free_bytes = database_size(db)
+
+    return {
+        "head_seq": head_seq(db),
+        "consumed_floor": floor,
+        "log_events": log_events,
+        "consumed_events": consumed,
+        "legacy_events": legacy,
+        "database_bytes": database_bytes,
+        "free_bytes": free_bytes,
+    }
+
+
+# ===================================================
+# Retention of the consumed events:
+# 1. A log event is consumed once every subscriber's offset is
+# past it (seq <= consumed_floor); nobody reads it again. The
+# consumed rows left in the legacy event table are drained too
+# 2. A consumed row expires when it is older than
+# EVENT_RETENTION_SECONDS, or when more than
+# EVENT_RETENTION_MAX_CONSUMED consumed rows exist (oldest first)
+# 3. Expired rows are archived (copied to EVENT_ARCHIVE_DATABASE)
+# or deleted in batches of EVENT_RETENTION_BATCH_SIZE, one short
+# transaction each with a pause in between, so publishers never
+# wait on more than one batch
+# 4. The freed pages are returned to the file system with
+# incremental_vacuum, also in small steps
+# Pending events are never touched.
+# ===================================================
+class EventRetention:
+    def __init__(self, database: str, mode: str = EVENT_RETENTION_MODE):
+        self.database = database
+        self.mode = mode
+        self.mutex = threading.Lock()
+        self.passes = 0
+        self.archived = 0
+        self.deleted = 0
+        self.reclaimed_bytes = 0
+        self.last_pass_at: Optional[str] = None
+        self.last_pass_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.thread = threading.Thread(
+            target=self.run_forever, name="event-retention", daemon=True
+        )
+
+    def start(self):
+        if self.mode != "off":
+            self.thread.start()
+
+    def open(self):
+        conn = connect(self.database)
+        if self.mode == "archive":
+            conn.execute("ATTACH DATABASE ? AS archive", (EVENT_ARCHIVE_DATABASE,))
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive.event (
+                    id INTEGER PRIMARY KEY,
+                    publisher_id TEXT,
+                    subscriber_id TEXT,
+                    published_at TEXT,
+                    consumed_at TEXT,
+                    operation TEXT,
+                    sub INTEGER,
+                    initial_balance INTEGER,
+                    current_balance INTEGER,
+                    delta INTEGER,
+                    coalesced_into INTEGER,
+                    archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+                """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive.event_log (
+                    seq INTEGER PRIMARY KEY,
+                    publisher_id TEXT,
+                    target_id TEXT,
+                    published_at TEXT,
+                    operation TEXT,
+                    sub INTEGER,
+                    initial_balance INTEGER,
+                    current_balance INTEGER,
+                    delta INTEGER,
+                    coalesced TEXT,
+                    event_key TEXT,
+                    archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+                """)
+            # An archive of an older version lacks the newer columns
+            archived_columns = {
+                row[1] for row in conn.execute("PRAGMA archive.table_info(event_log)")
+            }
+            for column, column_type in ARCHIVE_EVENT_LOG_ADDED_COLUMNS.items():
+                if column not in archived_columns:
+                    conn.execute(
+                        f"ALTER TABLE archive.event_log ADD COLUMN {column} {column_type}"
+                    )
+            conn.commit()
+        return conn
+
+    def expired_ids(
+        self, conn: Connection, table: dict, floor: int, cutoff: str, excess: int
+    ):
+        rows = conn.execute(
+            table["expired"], {"floor": floor, "limit": EVENT_RETENTION_BATCH_SIZE}
+        ).fetchall()
+
+        # Oldest first: the expired rows are a prefix of the batch
+        return [
+            key
+            for position, (key, moment) in enumerate(rows)
+            if moment <= cutoff or position < excess
+        ]
+
+    def remove(self, conn: Connection, table: dict, ids: list):
+        name, key, columns = table["table"], table["key"], table["columns"]
+        placeholders = ", ".join("?" * len(ids))
+        # Take the write lock up front: a deferred transaction that
+        # reads first fails at once ("database is locked") when a
+        # publisher commits before it upgrades to a write
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.mode == "archive":
+                # A batch retried after a failure is archived only once
+                conn.execute(
+                    f"""
+                    INSERT OR IGNORE INTO archive.{name} ({columns})
+                    SELECT {columns} FROM main.{name} WHERE {key} IN ({placeholders})
+                    """,
+                    ids,
+                )
+            removed = conn.execute(
+                f"DELETE FROM main.{name} WHERE {key} IN ({placeholders})", ids
+            ).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return removed
+
+    def vacuum(self, conn: Connection):
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while free_pages > 0:
+            # Every row returned is one page freed; fetch them all
+            # so the step runs to the end
+            conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # Not an incremental auto_vacuum database: nothing to do
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            time.sleep(EVENT_RETENTION_PAUSE_SECONDS)
+
+    # Returns the number of rows of `table` removed
+    def drain(self, conn: Connection, table: dict, floor: int, cutoff: str):
+        consumed = conn.execute(table["consumed"], {"floor": floor}).fetchone()[0]
+        excess = max(consumed - EVENT_RETENTION_MAX_CONSUMED, 0)
+
+        removed = 0
+        while True:
+            ids = self.expired_ids(conn, table, floor, cutoff, excess)
+            if not ids:
+                break
+            count = self.remove(conn, table, ids)
+            removed += count
+            excess = max(excess - count, 0)
+            with self.mutex:
+                if self.mode == "archive":
+                    self.archived += count
+                else:
+                    self.deleted += count
+            time.sleep(EVENT_RETENTION_PAUSE_SECONDS)
+        return removed
+
+    # Returns the number of events removed
+    def run_once(self, conn: Connection):
+        started = time.monotonic()
+        size_before, _ = database_size(conn)
+        cutoff = now_timestamp(-EVENT_RETENTION_SECONDS)
+        # Offsets only move forward: a floor read now stays safe
+        # for the whole pass
+        floor = consumed_floor(conn)
+
+        removed = 0
+        for table in RETAINED_TABLES:
+            removed += self.drain(conn, table, floor, cutoff)
+
+        if removed:
+            self.vacuum(conn)
+        size_after, _ = database_size(conn)
+
+        with self.mutex:
+            self.passes += 1
+            self.reclaimed_bytes += max(size_before - size_after, 0)
+            self.last_pass_at = now_timestamp()
+            self.last_pass_seconds = time.monotonic() - started
+            self.last_error = None
+
+        if removed:
+            print(
+                f"Event retention: {removed} events {self.mode}d, "
+                f"{size_before - size_after} bytes reclaimed"
+            )
+        return removed
+
+    def run_forever(self):
+        conn = self.open()
+
+        while True:
+            try:
+                self.run_once(conn)
+            except Exception as e:
+                with self.mutex:
+                    self.last_error = str(e)
+                print(f"Event retention failed: {str(e)}")
+            time.sleep(EVENT_RETENTION_INTERVAL_SECONDS)
+
+    def stats(self):
+        with self.mutex:
+            return {
+                "mode": self.mode,
+                "retention_seconds": EVENT_RETENTION_SECONDS,
+                "max_consumed": EVENT_RETENTION_MAX_CONSUMED,
+                "passes": self.passes,
+                "archived": self.archived,
+                "deleted": self.deleted,
+                "reclaimed_bytes": self.reclaimed_bytes,
+                "last_pass_at": self.last_pass_at,
+                "last_pass_seconds": self.last_pass_seconds,
+                "last_error": self.last_error,
+            }
+
+
+def start_event_retention(database: str = DATABASE) -> EventRetention:
+    retention = EventRetention(database)
+    retention.start()
+    return retention
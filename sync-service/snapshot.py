@@ -0,0 +1,70 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import json
+from sqlite3 import Connection
+
+from database import DATABASE, connect
+from event_store import NOT_ACKED, SUBSCRIBER_STREAM, committed_seq, head_seq
+
+# Balances read (and sent) per chunk of the stream
+SNAPSHOT_FETCH_SIZE = 10000
+
+
+# Last event id published before product_balance existed; the
+# snapshot is only complete when it is 0
+def balance_tracked_since(db: Connection):
+    return db.execute("SELECT MAX(event_id) FROM product_balance_since").fetchone()[0]
+
+
+# ===================================================
+# Snapshot of every product balance, as NDJSON:
+# 1. First line: {"watermark", "products", "pending"}. The
+# watermark is the last seq the balances reflect; pending counts
+# the branch's non-consumed events up to it
+# 2. Then one [product_id, balance] line per product, in id order
+# Everything is read in one read transaction, so the balances
+# match the watermark exactly while publishers keep writing.
+# Streamed in chunks of SNAPSHOT_FETCH_SIZE with a connection of
+# its own, closed when the client finishes or disconnects.
+# ===================================================
+def snapshot_lines(branch_id: str, database: str = DATABASE):
+    conn = connect(database)
+
+    try:
+        conn.execute("BEGIN")
+        watermark = head_seq(conn)
+        products = conn.execute("SELECT COUNT(*) FROM product_balance").fetchone()[0]
+        pending = conn.execute(
+            f"""
+            SELECT COUNT(*) FROM event_log
+            WHERE seq > :offset AND seq <= :watermark AND {SUBSCRIBER_STREAM} AND {NOT_ACKED}
+            """,
+            {
+                "offset": committed_seq(conn, branch_id) or 0,
+                "watermark": watermark,
+                "subscriber": branch_id,
+            },
+        ).fetchone()[0]
+        yield json.dumps(
+            {"watermark": watermark, "products": products, "pending": pending}
+        ) + "\n"
+
+        cursor = conn.execute(
+            "SELECT product_id, balance FROM product_balance ORDER BY product_id"
+        )
+        while True:
+            rows = cursor.fetchmany(SNAPSHOT_FETCH_SIZE)
+            if not rows:
+                break
+            yield "".join(f"[{product_id},{balance}]\n" for product_id, balance in rows)
+
+        conn.rollback()
+    finally:
+        conn.close()
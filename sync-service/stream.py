@@ -0,0 +1,149 @@
+# ===================================================
+# Autor: Moisés Silva de Azevedo
+#
+# Universidade Federal do Mato Grosso do Sul,
+# Câmpus de Três Lagoas (UFMS/CPTL),
+# Sistemas de Informaçao,
+# Computaçao Distribuída,
+# Novembro de 2025
+# ===================================================
+import asyncio
+import os
+
+from database import pool
+from event_store import consume_events
+from fastapi import WebSocket
+from fastapi.concurrency import run_in_threadpool
+from metrics import event_fan_out_seconds, timed
+from starlette.websockets import WebSocketDisconnect
+
+# Events sent per frame, at most (a frame only waits for what is
+# already queued, never for more events to arrive)
+STREAM_MAX_BATCH_EVENTS = int(os.getenv("STREAM_MAX_BATCH_EVENTS", "500"))
+# Publishes queued for a slow branch before its stream is closed;
+# it then reconnects and catches up from the event log
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "1000"))
+# Close code asking the branch to reconnect later ("Try Again Later")
+STREAM_OVERFLOW_CLOSE_CODE = 1013
+
+
+def ack_stream_events(branch_id: str, event_ids: list):
+    conn = pool.acquire()
+    try:
+        return consume_events(db=conn, subscriber_id=branch_id, event_ids=event_ids)
+    finally:
+        pool.release(conn)
+
+
+class BranchStream:
+    def __init__(self, branch_id: str, websocket: WebSocket):
+        self.branch_id = branch_id
+        self.websocket = websocket
+        self.outgoing = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.overflowed = asyncio.Event()
+        self.frames = 0
+        self.sent = 0
+        self.acked = 0
+
+    def push(self, payload: list):
+        try:
+            self.outgoing.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.overflowed.set()
+
+    async def send_forever(self):
+        while True:
+            events = list(await self.outgoing.get())
+            while len(events) < STREAM_MAX_BATCH_EVENTS and not self.outgoing.empty():
+                events.extend(self.outgoing.get_nowait())
+            with timed(event_fan_out_seconds, stage="stream"):
+                await self.websocket.send_json({"events": events})
+            self.frames += 1
+            self.sent += len(events)
+
+    async def receive_forever(self):
+        while True:
+            message = await self.websocket.receive_json()
+            event_ids = message.get("ack") or []
+            if event_ids:
+                self.acked += await run_in_threadpool(
+                    ack_stream_events, self.branch_id, event_ids
+                )
+
+    def to_dict(self):
+        return {
+            "queued": self.outgoing.qsize(),
+            "frames": self.frames,
+            "sent": self.sent,
+            "acked": self.acked,
+        }
+
+
+# ===================================================
+# Push channel of the branches (WebSocket /event/stream):
+# 1. Each branch keeps one stream open; a new connection of the
+# same branch replaces the old one
+# 2. Published events are queued per branch and sent as frames
+# {"events": [...]}, batching everything queued at that moment
+# (up to STREAM_MAX_BATCH_EVENTS events per frame)
+# 3. The branch acks inline with frames {"ack": [ids]}
+# 4. A branch that falls STREAM_QUEUE_SIZE publishes behind is
+# disconnected instead of buffering without bound; its events
+# stay non-consumed in the log and are caught up on reconnect
+# Everything runs on the event loop, except the acks (threadpool).
+# ===================================================
+class StreamHub:
+    def __init__(self):
+        self.streams = {}
+
+    # Queue the events for the branch's open stream. Returns False
+    # when it has none, so the caller falls back to /notify
+    def push(self, branch_id: str, payload: list):
+        stream = self.streams.get(branch_id)
+        if stream is None:
+            return False
+        stream.push(payload)
+        return True
+
+    async def serve(self, branch_id: str, websocket: WebSocket):
+        stream = BranchStream(branch_id, websocket)
+        previous = self.streams.get(branch_id)
+        self.streams[branch_id] = stream
+        if previous is not None:
+            try:
+                await previous.websocket.close()
+            except RuntimeError:
+                # Already closed by the branch
+                pass
+        print(f"Stream opened: {branch_id}")
+
+        tasks = [
+            asyncio.create_task(stream.send_forever()),
+            asyncio.create_task(stream.receive_forever()),
+            asyncio.create_task(stream.overflowed.wait()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = None if task.cancelled() else task.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    print(f"Stream failed: {branch_id} {str(error)}")
+            if stream.overflowed.is_set():
+                print(f"Stream overflowed, closing: {branch_id}")
+                await websocket.close(code=STREAM_OVERFLOW_CLOSE_CODE)
+        except Exception as e:
+            print(f"Stream failed: {branch_id} {str(e)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.streams.get(branch_id) is stream:
+                del self.streams[branch_id]
+            print(f"Stream closed: {branch_id}")
+
+    def stats(self):
+        return {
+            branch_id: stream.to_dict() for branch_id, stream in self.streams.items()
+        }
+
+
+stream_hub = StreamHub()
@@ -7,30 +7,101 @@
 # Computaçao Distribuída,
 # Novembro de 2025
 # ===================================================
-
+import os
 from sqlite3 import Connection, IntegrityError
+from typing import List, Optional
 
-import requests
 import uvicorn
-from database import get_db, start_database
-from fastapi import Depends, FastAPI, Response
-from models import LockProductIn
+from database import get_db, pool, start_database
+from event_store import (
+    coalesce_pending_updates,
+    consume_events,
+    consume_events_through,
+    fan_out_events,
+    pending_events,
+)
+from fastapi import Depends, FastAPI, Query, Response, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from lock_manager import start_lock_manager
+from metrics import (
+    CONTENT_TYPE,
+    MetricsMiddleware,
+    event_fan_out_seconds,
+    render,
+    timed,
+)
+from models import (
+    ConsumeBatchIn,
+    ConsumeThroughIn,
+    LockBatchIn,
+    LockProductIn,
+    LockReleaseBatchIn,
+)
+from notifier import close_notifier, notify_subscribers
+from partition import SYNC_PORT, foreign_products
+from partition import to_dict as partition_info
 from pydantic import BaseModel
+from retention import event_table_stats, start_event_retention
+from snapshot import balance_tracked_since, snapshot_lines
 from starlette.exceptions import HTTPException
 from starlette.status import (
     HTTP_201_CREATED,
+    HTTP_400_BAD_REQUEST,
     HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
+    HTTP_421_MISDIRECTED_REQUEST,
     HTTP_500_INTERNAL_SERVER_ERROR,
+    WS_1008_POLICY_VIOLATION,
 )
+from stream import stream_hub
 
 api = FastAPI()
+api.add_middleware(MetricsMiddleware)
+CATCH_UP_MAX_PAGE_SIZE = int(os.getenv("CATCH_UP_MAX_PAGE_SIZE", "1000"))
 
 start_database()
+lock_manager = start_lock_manager()
+event_retention = start_event_retention()
+
+
+@api.on_event("shutdown")
+async def close_clients():
+    await close_notifier()
+
+
+# ===================================================
+# A partition only serves its own products (see partition.py):
+# locks and events of another partition's products are refused
+# with 421, so a branch with a wrong partition map fails loudly
+# instead of splitting a product's locks or events in two.
+# ===================================================
+def check_partition(product_ids):
+    foreign = foreign_products(product_ids)
+    if foreign:
+        raise HTTPException(
+            status_code=HTTP_421_MISDIRECTED_REQUEST,
+            detail=f"Products of another partition: {foreign}",
+        )
+
+
+# Prometheus text format of this process' metrics (see metrics.py)
+@api.get("/metrics")
+def get_metrics():
+    return Response(content=render(), media_type=CONTENT_TYPE)
+
+
+# Which partition this process is, so branches can check their map
+@api.get("/partition")
+def get_partition():
+    return partition_info()
 
 
 class SubscribeIn(BaseModel):
     branch_id: str
-    branch_url: str
+    # Branches that only receive events on the stream (e.g. behind
+    # NAT) need no URL reachable from the sync service
+    branch_url: Optional[str] = None
 
 
 @api.post("/subscribe")
@@ -38,24 +109,31 @@ def subscribe(
     subscribe_data: SubscribeIn,
     db: Connection = Depends(get_db),
 ):
+    branch_url = subscribe_data.branch_url or f"stream://{subscribe_data.branch_id}"
+
     try:
         cursor = db.cursor()
 
         subscriber = cursor.execute(
             "SELECT id FROM subscriber WHERE id = ? OR branch_url = ?",
-            (subscribe_data.branch_id, subscribe_data.branch_url),
+            (subscribe_data.branch_id, branch_url),
         ).fetchone()
 
         if subscriber is not None:
             return
+        # A new branch reads the events published from now on
         cursor.execute(
-            "INSERT INTO subscriber (id, branch_url) VALUES (?, ?)",
-            (subscribe_data.branch_id, subscribe_data.branch_url),
+            """
+            INSERT INTO subscriber (id, branch_url, committed_seq) VALUES (?, ?, COALESCE(
+                (SELECT seq FROM sqlite_sequence WHERE name = 'event_log'), 0
+            ))
+            """,
+            (subscribe_data.branch_id, branch_url),
         )
 
         db.commit()
 
-        return {"message": f"{subscribe_data.branch_url} subscribed"}
+        return {"message": f"{branch_url} subscribed"}
     except IntegrityError as e:
         raise HTTPException(status_code=409, detail=str(e))
     except HTTPException:
@@ -74,56 +152,120 @@ class EventIn(BaseModel):
     delta: int
 
 
+class EventItemIn(BaseModel):
+    operation: str
+    sub: int
+    initial_balance: int
+    current_balance: int
+    delta: int
+    # Idempotency key of the event (one per outbox row of the
+    # publisher): a retried publish stores it only once
+    event_key: Optional[str] = None
+
+
+class EventBatchIn(BaseModel):
+    branch_id: str
+    events: List[EventItemIn]
+
+
+# Runs in the threadpool: stores the events and returns the
+# /notify payload of each subscriber
+def store_events(db: Connection, branch_id: str, events: list):
+    with timed(event_fan_out_seconds, stage="store"):
+        return fan_out_stored(db, branch_id, events)
+
+
+def fan_out_stored(db: Connection, branch_id: str, events: list):
+    cursor = db.cursor()
+
+    cursor.execute(
+        "SELECT id FROM subscriber WHERE id = ?",
+        (branch_id,),
+    )
+    result = cursor.fetchone()
+
+    if result is None:
+        raise HTTPException(status_code=404, detail="Publisher not found.")
+
+    publisher_id = result[0]
+
+    stored, subscribers = fan_out_events(
+        db=db, publisher_id=publisher_id, events=events
+    )
+    if len(stored) < len(events):
+        print(f"Skipped {len(events) - len(stored)} events already published")
+    if not stored:
+        return []
+
+    # Every subscriber gets the same events, so one payload is shared
+    payload = [
+        {
+            "event_consumer_id": seq,
+            "publisher_branch_id": publisher_id,
+            "operation": event["operation"],
+            "sub": event["sub"],
+            "initial_balance": event["initial_balance"],
+            "current_balance": event["current_balance"],
+            "delta": event["delta"],
+        }
+        for seq, event in stored
+    ]
+    return [
+        (subscriber_id, branch_url, payload)
+        for subscriber_id, branch_url in subscribers
+    ]
+
+
+# ===================================================
+# Store a batch of events from one publisher and fan it out:
+# 1. The events are written to the log in one transaction
+# 2. Each subscriber gets the whole batch on its stream, or in
+# one /notify call when it has no stream open
+# 3. Returns once the events are stored, delivery runs in background
+# ===================================================
+async def publish(db: Connection, branch_id: str, events: list):
+    check_partition(event["sub"] for event in events)
+    deliveries = await run_in_threadpool(store_events, db, branch_id, events)
+
+    # Events are stored, so the publisher does not wait for the branches
+    notify_subscribers(deliveries)
+
+    return {
+        "message": "Event published",
+        "events": len(events),
+        "subscribers": len(deliveries),
+    }
+
+
 @api.post("/event/publish")
-def publish_event(
+async def publish_event(
     event_data: EventIn,
     db: Connection = Depends(get_db),
 ):
     try:
-        cursor = db.cursor()
-
-        cursor.execute(
-            "SELECT id FROM subscriber WHERE id = ?",
-            (event_data.branch_id,),
+        return await publish(
+            db=db,
+            branch_id=event_data.branch_id,
+            events=[event_data.model_dump(exclude={"branch_id"})],
         )
-        result = cursor.fetchone()
-
-        if result is None:
-            raise HTTPException(status_code=404, detail="Publisher not found.")
-
-        publisher_id = result[0]
-
-        subscribers = cursor.execute("SELECT id, branch_url FROM subscriber").fetchall()
-        for row in subscribers:
-            branch_url = row["branch_url"]
-            event_id = cursor.execute(
-                "INSERT INTO event (publisher_id, subscriber_id, operation, sub, initial_balance, current_balance, delta) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (
-                    publisher_id,
-                    row["id"],
-                    event_data.operation,
-                    event_data.sub,
-                    event_data.initial_balance,
-                    event_data.current_balance,
-                    event_data.delta,
-                ),
-            ).lastrowid
-            db.commit()
-
-            result = requests.post(
-                f"{branch_url}/notify",
-                json={
-                    "event_consumer_id": event_id,
-                    "publisher_branch_id": publisher_id,
-                    "operation": event_data.operation,
-                    "sub": event_data.sub,
-                    "initial_balance": event_data.initial_balance,
-                    "current_balance": event_data.current_balance,
-                    "delta": event_data.delta,
-                },
-            )
-            print(f"notify result: {result.status_code} {result.json()}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(str(e))
+        raise HTTPException(status_code=500, detail=str(e))
 
+
+@api.post("/event/publish-batch")
+async def publish_event_batch(
+    event_batch_data: EventBatchIn,
+    db: Connection = Depends(get_db),
+):
+    try:
+        return await publish(
+            db=db,
+            branch_id=event_batch_data.branch_id,
+            events=[event.model_dump() for event in event_batch_data.events],
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -131,96 +273,282 @@ def publish_event(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ===================================================
+# Ack a single event. Events are shared by every branch, so the
+# branch is given by ?branch_id=; without it, only an event
+# addressed to a single branch (a coalesced one) can be acked.
+# ===================================================
 @api.patch("/event/consume/{id}")
-def consume_event(id: int, db: Connection = Depends(get_db)):
+def consume_event(
+    id: int, branch_id: Optional[str] = None, db: Connection = Depends(get_db)
+):
     cursor = db.cursor()
 
     try:
         instance = cursor.execute(
-            "SELECT id FROM event WHERE id = ?",
+            "SELECT seq, target_id FROM event_log WHERE seq = ?",
             (id,),
         ).fetchone()
 
-        print(id, instance)
-
         if instance is None:
             raise HTTPException(status_code=HTTP_404_NOT_FOUND)
-        cursor.execute(
-            "UPDATE event SET consumed_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (id,),
-        )
-        db.commit()
+        subscriber_id = branch_id or instance["target_id"]
+        if subscriber_id is None:
+            raise HTTPException(
+                status_code=HTTP_400_BAD_REQUEST,
+                detail="branch_id is required to ack an event sent to every branch.",
+            )
+        consume_events(db=db, subscriber_id=subscriber_id, event_ids=[id])
 
-        print(f"Event instace {id} consumed.")
+        print(f"Event {id} consumed by {subscriber_id}.")
     except HTTPException:
         raise
     except Exception:
         HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+# ===================================================
+# Batch acknowledgment: marks a list of the branch's events as
+# consumed with one request and one commit, instead of one
+# PATCH /event/consume/{id} round trip per event.
+# ===================================================
+@api.patch("/event/consume")
+def consume_event_batch(
+    consume_batch_data: ConsumeBatchIn,
+    db: Connection = Depends(get_db),
+):
+    try:
+        consumed = consume_events(
+            db=db,
+            subscriber_id=consume_batch_data.branch_id,
+            event_ids=consume_batch_data.event_ids,
+        )
+        print(f"{consumed} events of {consume_batch_data.branch_id} consumed.")
+
+        return {"consumed": consumed, "requested": len(consume_batch_data.event_ids)}
+    except Exception as e:
+        print(str(e))
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+# ===================================================
+# After loading a snapshot, a branch marks every pending event
+# up to the snapshot's watermark as consumed: the snapshot
+# already reflects them. Idempotent.
+# ===================================================
+@api.patch("/event/consume-through")
+def consume_event_through(
+    consume_through_data: ConsumeThroughIn,
+    db: Connection = Depends(get_db),
+):
+    try:
+        consumed = consume_events_through(
+            db=db,
+            subscriber_id=consume_through_data.branch_id,
+            watermark=consume_through_data.watermark,
+        )
+        print(
+            f"{consumed} events of {consume_through_data.branch_id} consumed "
+            f"through {consume_through_data.watermark}."
+        )
+
+        return {"consumed": consumed, "watermark": consume_through_data.watermark}
+    except Exception as e:
+        print(str(e))
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+# ===================================================
+# Bootstrap snapshot for new or long-offline branches:
+# every product balance plus the event watermark it reflects,
+# streamed as NDJSON (see snapshot.py). The branch bulk-loads it
+# and replays only its events after the watermark.
+# 409 when balances were not tracked since the first event
+# (database older than the snapshot): the branch falls back to
+# replaying its events.
+# ===================================================
+@api.get("/snapshot")
+def get_snapshot(branch_id: str, db: Connection = Depends(get_db)):
+    if balance_tracked_since(db) > 0:
+        raise HTTPException(
+            status_code=HTTP_409_CONFLICT,
+            detail="Balances not tracked since the first event, snapshot incomplete.",
+        )
+
+    return StreamingResponse(
+        snapshot_lines(branch_id), media_type="application/x-ndjson"
+    )
+
+
+# ===================================================
+# Catch-up of a branch, keyset-paginated:
+# 1. Returns up to `limit` events of the branch not consumed yet
+# (past its offset, not acked) with id (seq) > after_id, in order
+# 2. The branch asks for the next page with the last id it got
+# 3. On the first page, pending UPDATEs of the same product are
+# coalesced into one net delta
+# ===================================================
 @api.get("/event/non-consumed/{branch_id}")
-def get_events_not_consumed(branch_id, db: Connection = Depends(get_db)):
-    cursor = db.cursor()
-    result = cursor.execute(
-        "SELECT * FROM event WHERE subscriber_id = ? AND publisher_id != ? AND consumed_at IS NULL",
-        (branch_id, branch_id),
-    ).fetchall()
-    return result
+def get_events_not_consumed(
+    branch_id,
+    after_id: int = 0,
+    limit: int = Query(default=CATCH_UP_MAX_PAGE_SIZE, gt=0),
+    db: Connection = Depends(get_db),
+):
+    if after_id == 0:
+        merged = coalesce_pending_updates(db=db, subscriber_id=branch_id)
+        if merged:
+            print(f"Coalesced {merged} pending UPDATE events of {branch_id}")
+
+    return pending_events(
+        db=db,
+        subscriber_id=branch_id,
+        after_seq=after_id,
+        limit=min(limit, CATCH_UP_MAX_PAGE_SIZE),
+    )
+
+
+# Retention progress (events archived or deleted, bytes given back
+# to the file system) and the current size of the event log
+@api.get("/event/retention")
+def get_event_retention(db: Connection = Depends(get_db)):
+    return {**event_retention.stats(), **event_table_stats(db)}
+
+
+def subscriber_exists(branch_id: str):
+    conn = pool.acquire()
+    try:
+        return (
+            conn.execute(
+                "SELECT 1 FROM subscriber WHERE id = ?", (branch_id,)
+            ).fetchone()
+            is not None
+        )
+    finally:
+        pool.release(conn)
+
+
+# ===================================================
+# Push channel of a subscribed branch (see stream.py): events are
+# sent as they are published, in frames of many events, and the
+# branch acks them on the same connection. Unknown branches are
+# refused before the handshake completes.
+# ===================================================
+@api.websocket("/event/stream/{branch_id}")
+async def event_stream(websocket: WebSocket, branch_id: str):
+    if not await run_in_threadpool(subscriber_exists, branch_id):
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    await stream_hub.serve(branch_id, websocket)
+
+
+# Open streams: events queued, frames and events sent, events acked
+@api.get("/event/streams")
+def get_event_streams():
+    return stream_hub.stats()
 
 
 @api.get("/lock/{id}")
-def get_product_lock(product_id: int = 0, db: Connection = Depends(get_db)):
-    cursor = db.cursor()
-    lock = cursor.execute(
-        "SELECT * FROM lock WHERE product_id = ? AND released_at IS NULL",
-        (product_id,),
-    ).fetchone()
+def get_product_lock(product_id: int = 0):
+    lease = lock_manager.get(product_id)
 
-    print("lock: ", lock)
-    if lock is None:
+    print("lock: ", lease)
+    if lease is None:
         raise HTTPException(status_code=HTTP_404_NOT_FOUND)
 
-    return lock
+    return lease.to_dict()
 
 
+# ===================================================
+# Try to lock a product in a single round trip:
+# 201 with the lock id, or 409 when the product already has
+# an active lock. Locks are leases kept in memory by the
+# lock manager and expire after ttl_seconds (LOCK_TTL_SECONDS
+# by default) unless renewed.
+# ===================================================
 @api.post("/lock")
-def lock_product(
-    response: Response,
-    product_lock_data: LockProductIn,
-    db: Connection = Depends(get_db),
-):
-    cursor = db.cursor()
+def lock_product(response: Response, product_lock_data: LockProductIn):
+    check_partition([product_lock_data.product_id])
+    lease = lock_manager.acquire(
+        product_id=product_lock_data.product_id,
+        branch=product_lock_data.branch,
+        ttl=product_lock_data.ttl_seconds,
+    )
 
-    lock_id = cursor.execute(
-        "INSERT INTO lock (branch, product_id) VALUES (?, ?)",
-        (
-            product_lock_data.branch,
-            product_lock_data.product_id,
-        ),
-    ).lastrowid
-    db.commit()
+    if lease is None:
+        raise HTTPException(
+            status_code=HTTP_409_CONFLICT,
+            detail=f"Product {product_lock_data.product_id} is already locked.",
+        )
 
     response.status_code = HTTP_201_CREATED
-    return {"lock_id": lock_id, "detail": "Product locked."}
+    return {
+        "lock_id": lease.id,
+        "expires_in": lease.to_dict()["expires_in"],
+        "detail": "Product locked.",
+    }
 
 
-@api.patch("/lock/{lock_id}/release")
-def release_lock(lock_id: int, db: Connection = Depends(get_db)):
-    cursor = db.cursor()
+# ===================================================
+# Lock a set of products in one request:
+# 1. Products are locked in ascending id order (no deadlock)
+# 2. all_or_nothing=true: 409 and nothing locked on any conflict
+# 3. all_or_nothing=false: lock what is free, report the rest
+# ===================================================
+@api.post("/lock/batch")
+def lock_products(response: Response, lock_batch_data: LockBatchIn):
+    check_partition(lock_batch_data.product_ids)
+    leases, conflicts = lock_manager.acquire_many(
+        product_ids=lock_batch_data.product_ids,
+        branch=lock_batch_data.branch,
+        ttl=lock_batch_data.ttl_seconds,
+        all_or_nothing=lock_batch_data.all_or_nothing,
+    )
+
+    if conflicts and lock_batch_data.all_or_nothing:
+        raise HTTPException(
+            status_code=HTTP_409_CONFLICT,
+            detail=f"Products already locked: {conflicts}",
+        )
+
+    response.status_code = HTTP_201_CREATED
+    return {
+        "locks": [
+            {"product_id": lease.product_id, "lock_id": lease.id} for lease in leases
+        ],
+        "conflicts": conflicts,
+    }
+
+
+@api.patch("/lock/batch/release")
+def release_locks(release_batch_data: LockReleaseBatchIn):
+    released, not_found = lock_manager.release_many(release_batch_data.lock_ids)
+    print(f"Locks {released} released")
+
+    return {"released": released, "not_found": not_found}
 
-    lock = cursor.execute(
-        "SELECT * FROM lock WHERE id = ? AND released_at IS NULL", (lock_id,)
-    ).fetchone()
 
-    if lock is None:
+@api.patch("/lock/{lock_id}/renew")
+def renew_lock(lock_id: int, ttl_seconds: Optional[float] = Query(default=None, gt=0)):
+    lease = lock_manager.renew(lock_id, ttl=ttl_seconds)
+
+    if lease is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Lock not found.")
+
+    return lease.to_dict()
+
+
+@api.patch("/lock/{lock_id}/release")
+def release_lock(lock_id: int):
+    lease = lock_manager.release(lock_id)
+
+    if lease is None:
         raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Lock not found.")
 
-    cursor.execute(
-        "UPDATE lock SET released_at = CURRENT_TIMESTAMP WHERE id = ?", (lock_id,)
-    )
-    db.commit()
     print(f"Lock {lock_id} released")
 
 
-uvicorn.run(api, host="0.0.0.0", port=4000)
-print("Sync service running on port 4000")
+uvicorn.run(api, host="0.0.0.0", port=SYNC_PORT)
+print(f"Sync service running on port {SYNC_PORT}")